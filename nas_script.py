@@ -37,6 +37,11 @@ NasGroup = 'rpinas'  # NAS permission group name
 # ----- Other settings -----------------
 
 SDCountdown = 300    # Low battery shutdown countdown timer (seconds)
+ProbeWorkers = 4     # Max number of disks probed (woken up) in parallel at startup and hotplug
+DiskPollPeriod = 2   # Disk IO counters polling period (seconds), standby deadlines are checked in between
+KAWindow = (0.80, 0.95)  # Keep alive reads rotate through this part of the disk (fractions of its size)
+ShutdownBudget = 12  # Max time (seconds) the shutdown/reboot hook may take before the Pico is signaled
+HookPushTimeout = 3  # Max time (seconds) for a push notification sent by the shutdown/reboot hook
 
 
 # ========================== BASIC SETUP ===================================
@@ -69,6 +74,8 @@ LogD(0, 'App started'+'-'*40)
 
 ParamList = sys.argv[1:] 
 Debug = not any(param == '-sys' for param in ParamList)
+FakeAta = Debug and any(param == '-fakeata' for param in ParamList)   # emulate SG_IO, see FakeAtaTransport
+HookMode = any(param in ('-shutdown', '-reboot') for param in ParamList)   # systemd hook: park, notify, cut the power
 InstDeps = Debug and any(param.startswith('-install') for param in ParamList) and not any(param == '-nodeps' for param in ParamList)
 
 if os.geteuid() != 0:
@@ -143,7 +150,7 @@ if InstDeps:
   try:
     SysDeps = [
       [ CheckInstDpkg, ['apt',  'install', '-y'], ['python3-pip', 'samba', 'samba-common-bin', 'smbclient', 'hdparm', 'smartmontools'] ],
-      [ CheckInstImp,  ['apt',  'install', '-y'], ['python3-psutil', 'python3-netifaces', 'python3-pyudev', 'python3-dbus'] ], 
+      [ CheckInstImp,  ['apt',  'install', '-y'], ['python3-psutil', 'python3-netifaces', 'python3-pyudev'] ], 
       [ CheckInstImp,  ['pip3', 'install', '--break-system-packages'], [
           ['gpiod',    '2',     'gpiod', 'libgpiod2', 'python3-libgpiod'] ] ]
     ]     # to install, min.ver, to remove...    
@@ -180,15 +187,18 @@ LogD(1, 'Passed dependencies install')
 
 # --- Internal Modules ----------
 
-import os.path, socket, signal, threading, configparser, select, asyncio
-import fcntl, struct, re, mmap, grp, pwd, traceback, shutil, pty, requests
+import os.path, socket, signal, threading, configparser, select
+import fcntl, struct, re, mmap, grp, pwd, traceback, shutil, pty, requests, array, heapq, queue
+import concurrent.futures, ctypes, errno, json, math
 from datetime import timedelta
 
 # --- External Modules ----------
 
-import gpiod, psutil, netifaces, pyudev
+import gpiod
 from smbus2 import SMBus 
 from gpiod.line import Edge, Bias, Direction
+if not HookMode:   # the hook does not run the daemon, skip what only the daemon uses
+  import asyncio, psutil, netifaces, pyudev
 
 LogD(2, 'Modules imported')
 
@@ -294,6 +304,13 @@ CMD_THEEND     = b'\xDB\x00\x01\x2C'
 CMD_UPSRST     = b'\xDB\x00\x01\x2D'
 CMD_INSTCHECK  = b'\xDB\x00\x01\x2E'
 CMD_GETAPM     = b'\xDB\x00\x01\x2F'
+CMD_DEVSTAT    = b'\xDB\x00\x01\x30'   # comp: enable delta updates / raspi: status of the changed disks only
+CMD_LOCKSTAT   = b'\xDB\x00\x01\x31'   # lock wait / hold statistics per call site
+CMD_SMARTHIST  = b'\xDB\x00\x01\x32'   # downsampled SMART attribute history of a disk
+CMD_STBLEARN   = b'\xDB\x00\x01\x33'   # standby config with the learned timeouts appended
+CMD_PREDSTAT   = b'\xDB\x00\x01\x34'   # pre-spin hit / miss statistics
+CMD_WEARSTAT   = b'\xDB\x00\x01\x35'   # spin cycles, time spinning / in standby and energy saved per disk
+CMD_WAKERS     = b'\xDB\x00\x01\x36'   # processes ranked by the standby exits they caused
 
 CMD_FAILED     = b'\xDB\x00\x02\x01'
 CMD_SUCCESS    = b'\xDB\x00\x02\x02'
@@ -356,6 +373,8 @@ BatLostMsg    = 10
 BatAvailMsg   = 11
 BatOvr1Msg    = 12
 BatOvr0Msg    = 13
+SlowDisk1Msg  = 14
+SlowDisk0Msg  = 15
 
 BrdMsg = [
  'Raspberry Pi is back online: Main is {}, Batt is {}',
@@ -371,7 +390,9 @@ BrdMsg = [
  'Warning: Battery has been disconnected !',
  'The battery has been reconnected.',
  'Warning: Battery overvoltage detected !',
- 'Battery voltage is now at a safe level.']
+ 'Battery voltage is now at a safe level.',
+ 'Warning: disk {} is slow !\nLatency p50/p95/p99: {}/{}/{} ms, its baseline is {} ms.',
+ 'Disk {} latency is back to normal: {} ms.']
 
 SrvResetStr     = 'The Raspberry server was restarted.'
 PowerFailureMsg = 'Warning: power failure detected !'
@@ -432,6 +453,9 @@ BatOvr1.log = yes
 BatOvr0.comp = yes
 BatOvr0.push = yes
 BatOvr0.log = yes
+SlowDisk.comp = yes
+SlowDisk.push = yes
+SlowDisk.log = yes
 UseIdle = yes
 IdleVal = 10
 
@@ -442,6 +466,16 @@ Default = 5/30
 
 [StandbyCustom]
 
+[StandbyAdaptive]
+Enabled = no
+MinSBT = 5
+MaxSBT = 120
+IdleWatts = 5.0
+StandbyWatts = 0.8
+CycleCost = 1500
+MinSamples = 20
+SpinUpWs = 150
+
 [APM]
 Enabled = yes
 Default = 254
@@ -450,6 +484,31 @@ Default = 254
 
 [ApmAvail]
 
+[SMART]
+TTL = 3600
+
+[Prespin]
+Enabled = no
+Lead = 120
+Threshold = 0.5
+Decay = 0.8
+
+[Wakers]
+Enabled = no
+Trace = yes
+Top = 5
+
+[SpinUp]
+MaxDisks = 2
+BatteryMax = 1
+Stagger = 3
+
+[Latency]
+Window = 300
+Factor = 4
+MinAwait = 50
+Hold = 60
+
 [Cooling]
 NasFAuto = yes
 NasLowTemp = 3800
@@ -502,35 +561,40 @@ crc8_tab = (
 
 # ----- Devices Database -------------------
 
-DevList = []  # DevList = array of Disk
-
-# Disk
-#  [0] - Device name      (String)
-#  [1] - Device path      (String)
-#  [2] - Device serial    (String)
-#  [3] - Size             (UInt64)
-#  [4] - Rotational       (Byte)    0 = unknown, 1 = SSD, 2 = HDD
-#  [5] - Drive Status     (-obj-)
-#  [6] - Partitions       (-obj-)
-#  [7] - APM Available    (Byte)    0 = unknown, 1 = no,  2 = yes
-
-# Drive Status
-#  [0] - IO count         (UInt64)
-#  [1] - keep alive count (UInt32)  [CheckPeriod multiple]
-#  [2] - idle count       (UInt32)  [CheckPeriod multiple]
-#  [3] - State code       (Byte)    0 = unknown, 1 = active, 2 = standby
-#  [4] - State name       (String)
-#  [5] - KAS level
-#  [6] - SBT level
-
-# Disk Partition
-#  [0] - Device name      (String)
-#  [1] - Device path      (String)
-#  [2] - Label            (String)
-#  [3] - UUID             (String)
-#  [4] - File system type (String)
-#  [5] - Size             (UInt64)
-#  [6] - Mount Point      (-obj-)
+# DevReg = DeviceRegistry of DiskRec, indexed by device node, serial and partition node
+
+# DiskRec
+#  Name           - Device name      (String)
+#  Node           - Device path      (String)
+#  Serial         - Device serial    (String)
+#  Size           - Size             (UInt64)
+#  Rot            - Rotational       (Byte)    0 = unknown, 1 = SSD, 2 = HDD
+#  Class          - Disk class       (DiskClass)
+#  Stat           - Drive Status     (DiskStatus)
+#  Parts          - Partitions       (list of PartRec)
+#  ApmAvail       - APM Available    (Byte)    0 = unknown, 1 = no,  2 = yes
+#  Group          - Volume group     (String)  md / dm holder or btrfs filesystem shared with other disks, '' = none
+
+# DiskStatus
+#  IOCount        - IO count         (UInt64)
+#  KACount        - keep alive count (UInt32)  [CheckPeriod multiple, derived from KAStamp]
+#  IdleCount      - idle count       (UInt32)  [CheckPeriod multiple, derived from IdleStamp]
+#  KAStamp        - monotonic time of the last activity or keep alive
+#  IdleStamp      - monotonic time of the last activity
+#  Token          - DiskScheduler entry id, older heap entries of the disk are stale
+#  State          - State code       (Byte)    0 = unknown, 1 = active, 2 = standby
+#  StateName      - State name       (String)
+#  KAS            - KAS level
+#  SBT            - SBT level
+
+# PartRec
+#  Name           - Device name      (String)
+#  Node           - Device path      (String)
+#  Label          - Label            (String)
+#  UUID           - UUID             (String)
+#  FSType         - File system type (String)
+#  Size           - Size             (UInt64)
+#  Mount          - Mount Point      (-obj-)
 
 # Mount Point
 #  [0] - Folder name      (String)
@@ -700,40 +764,529 @@ class GpioMonitor(threading.Thread):
               except: pass
 
 
+#------ Keep Alive Service Classes --------------------
+
+class KAWorker(threading.Thread):  # one per disk: its O_DIRECT fd and aligned buffer live as long as the disk
+  def __init__(self, dev_node):
+    super().__init__(name=f'KeepAlive {dev_node}')
+    self.daemon = True
+    self.dev_node = dev_node
+    self.jobs = queue.SimpleQueue()   # [done Event, result, Notify, Awake, cancelled] or None to exit
+    self.fd = -1
+    self.size = 0
+    self.step = 0
+    self.buff = mmap.mmap(-1, 4096)   # page aligned, as O_DIRECT requires
+    self.start()
+
+  def Request(self, Notify=None, Awake=False):
+    job = [threading.Event(), 0, Notify, Awake, False]
+    self.jobs.put(job)
+    return job
+
+  def Terminate(self):
+    self.jobs.put(None)
+
+  def NextOffset(self):              # golden ratio steps: every read lands on a different, far away block
+    self.step += 1
+    lo = int(self.size * KAWindow[0]); span = max(int(self.size * KAWindow[1]) - lo, 4096)
+    frac = (self.step * 0.6180339887498949) % 1.0
+    return (lo + int(frac * span)) // 4096 * 4096
+
+  def Read(self):
+    for retry in range(2):            # the second try reopens a fd gone stale (disk reset or replugged)
+      try:
+        if self.fd < 0:
+          self.fd = os.open(self.dev_node, os.O_RDONLY | os.O_DIRECT)
+          self.size = os.lseek(self.fd, 0, os.SEEK_END)
+        os.preadv(self.fd, [self.buff], self.NextOffset())
+        return 1
+      except Exception as E:
+        self.Close()
+        if retry > 0 and Debug: print(f' KeepAlive error: {E}')
+    return 0
+
+  def Close(self):
+    if self.fd >= 0:
+      try: os.close(self.fd)
+      except: pass
+      self.fd = -1
+
+  def run(self):
+    try:
+      while True:
+        job = self.jobs.get()
+        if job == None: return
+        if job[4]: job[0].set(); continue                # the caller gave up, a late read would wake the disk
+        ticket = None if job[3] or not SpinUp.Needed(self.dev_node) else SpinUp.Acquire(self.dev_node, job[2], job)
+        try:
+          if not job[4]: job[1] = self.Read()
+        finally:
+          if ticket != None: SpinUp.Release(ticket)
+        job[0].set()
+    finally:
+      self.Close()
+      self.buff.close()
+
+class KAService:
+  def __init__(self):
+    self.Access = threading.Lock()
+    self.Workers = {}     # dev_node -> KAWorker
+
+  def Request(self, dev_node, Notify=None, Awake=False):
+    with self.Access:
+      worker = self.Workers.get(dev_node)
+      if (worker == None) or not worker.is_alive():
+        worker = self.Workers[dev_node] = KAWorker(dev_node)
+      return worker.Request(Notify, Awake)
+
+  def KeepAlive(self, dev_nodes, timeout=30, Notify=None, Awake=False):  # all disks are read in parallel / return: number of disks read
+    jobs = [self.Request(dev_node, Notify, Awake) for dev_node in dev_nodes]
+    deadline = time.monotonic() + timeout; result = 0
+    for job in jobs:
+      if job[0].wait(max(deadline - time.monotonic(), 0)): result += job[1]
+      else: job[4] = True                                # timed out: drop it from the worker and spin-up queues
+    return result
+
+  def Drop(self, dev_node):  # disk removed: close its fd
+    with self.Access: worker = self.Workers.pop(dev_node, None)
+    if worker != None: worker.Terminate()
+
+  def Terminate(self):
+    with self.Access:
+      workers = list(self.Workers.values()); self.Workers = {}
+    for worker in workers: worker.Terminate()
+
+
+#------ Spin-Up Scheduler Class --------------------
+
+class SpinUpScheduler:  # every wake goes through the keep alive workers, they ask here before reading a sleeping disk
+  def __init__(self):
+    self.Cond = threading.Condition()
+    self.Queue = []           # tickets waiting, FIFO
+    self.Busy = set()         # tickets spinning up
+    self.Seq = 0
+    self.LastStart = 0
+    self.OnBattery = False    # set by the UPS events
+    self.Max = Config['SpinUp'].getint('MaxDisks', 2)
+    self.BatMax = Config['SpinUp'].getint('BatteryMax', 1)
+    self.Stagger = Config['SpinUp'].getfloat('Stagger', 3)
+
+  def Needed(self, dev_node):  # a disk that cannot tell its power mode is treated as sleeping
+    Power, Err = AtaRun(dev_node, AtaCheckPower)
+    return (Power == None) or (Power == 0x00)
+
+  def Acquire(self, dev_node, Notify=None, Job=None):  # blocks until the disk may spin up / Notify(dev_node, position) while queued
+    Reported = 0                                                # return: None if the keep alive Job was cancelled meanwhile
+    with self.Cond:
+      self.Seq += 1; ticket = (dev_node, self.Seq)
+      self.Queue.append(ticket)
+    while True:
+      with self.Cond:
+        if (Job != None) and Job[4]:
+          self.Queue.remove(ticket); self.Cond.notify_all()
+          return None
+        Limit = max(self.BatMax if self.OnBattery else self.Max, 1)
+        pos = self.Queue.index(ticket) + 1
+        Wait = self.LastStart + self.Stagger - time.monotonic()
+        if (pos == 1) and (len(self.Busy) < Limit) and (Wait <= 0):
+          self.Queue.pop(0); self.Busy.add(ticket)
+          self.LastStart = time.monotonic()
+          self.Cond.notify_all()
+          return ticket
+        if (Notify == None) or (pos == Reported):
+          Timeout = Wait if (pos == 1) and (len(self.Busy) < Limit) else None
+          if Job != None: Timeout = 1 if Timeout == None else min(Timeout, 1)   # look at the cancel flag now and then
+          self.Cond.wait(Timeout)
+          continue
+      Reported = pos; Notify(dev_node, pos)    # outside the lock, it talks to the app
+
+  def Release(self, ticket):  # the first read returned, the disk is spinning
+    with self.Cond:
+      self.Busy.discard(ticket)
+      self.Cond.notify_all()
+
+  def SetPower(self, OnBattery):
+    with self.Cond:
+      self.OnBattery = OnBattery
+      self.Cond.notify_all()
+
+  def Stats(self):  # return: spinning up, queued
+    with self.Cond: return len(self.Busy), len(self.Queue)
+
+
+#------ SMART Cache Class --------------------
+
+class SmartProbe:  # typed result of one smartctl --json run
+  __slots__ = ('Info', 'Features', 'Attrs', 'Health', 'APM', 'Asleep', 'Error')
+
+  def __init__(self):
+    self.Info = []        # (label, value) identity lines
+    self.Features = []    # (name, enabled, detail)
+    self.Attrs = []       # [id, name, flags, value, worst, thresh, raw]
+    self.Health = 'UNKNOWN'
+    self.APM = None       # level, 0x100 = disabled, 0x200 = unavailable, None = unknown
+    self.Asleep = False   # skipped by -n standby
+    self.Error = None
+
+class SmartRec:
+  __slots__ = ('Attrs', 'Health', 'Stamp')
+
+  def __init__(self, Attrs, Health):
+    self.Attrs = Attrs                # ProbeSMART attribute list
+    self.Health = Health
+    self.Stamp = time.monotonic()
+
+  def Age(self):
+    return int(time.monotonic() - self.Stamp)
+
+class SmartCache(threading.Thread):  # keyed by serial, refreshed in background only while the disk is awake
+  def __init__(self):
+    super().__init__(name='SMART Refresher')
+    self.daemon = True
+    self.Access = threading.Lock()
+    self.Items = {}       # serial -> SmartRec
+    self.Pending = {}     # serial -> [dev_node, reply to the app]
+    self.Wake = threading.Event()
+    self.start()
+
+  def Get(self, serial):
+    with self.Access: return self.Items.get(serial)
+
+  def Due(self, serial, TTL):
+    with self.Access:
+      rec = self.Items.get(serial)
+      return (rec == None) or (rec.Age() >= TTL)
+
+  def Refresh(self, dev_node, serial, Reply=False):
+    with self.Access:
+      job = self.Pending.get(serial)
+      if job == None: self.Pending[serial] = [dev_node, Reply]
+      else: job[1] = job[1] or Reply
+    self.Wake.set()
+
+  def run(self):
+    while True:
+      self.Wake.wait(); self.Wake.clear()
+      while True:
+        with self.Access:
+          if len(self.Pending) == 0: break
+          serial, (dev_node, Reply) = self.Pending.popitem()
+        probe = ProbeSMART(dev_node, True)         # -n standby: a sleeping disk is skipped, not woken
+        if probe.Error == None:
+          self.Store(serial, probe)
+          if Reply: SendSMART(dev_node, serial)
+        elif Reply: SendMessageToComp(CMD_MESSAGE, probe.Error, 2 if probe.Asleep else 3)
+
+  def Store(self, serial, probe):  # any successful probe is a fresh sample
+    with self.Access: self.Items[serial] = SmartRec(probe.Attrs, probe.Health)
+    SmartHist.Append(serial, probe.Attrs)
+    Wear.Smart(serial, probe.Attrs)
+
+
+#------ SMART History Class --------------------
+
+HistAttrs  = (5, 197, 198, 199, 194, 190, 193, 4, 9)   # reallocated, pending, uncorrectable, CRC, temperatures, load / start-stop cycles, power on hours
+HistRowFmt = '<I' + 'BQ' * len(HistAttrs)             # unix time, then normalized and raw value of each attribute
+HistRowLen = struct.calcsize(HistRowFmt)
+HistPeriod = 3000                                     # min seconds between two samples
+HistNone   = 0xFFFFFFFFFFFFFFFF                       # raw value of a missing attribute
+
+class HistColumns:  # array backed columns of one disk
+  def __init__(self):
+    self.Times = array.array('I')
+    self.Norm = [array.array('B') for attr in HistAttrs]
+    self.Raw = [array.array('Q') for attr in HistAttrs]
+
+  def Add(self, row):
+    self.Times.append(row[0])
+    for I in range(len(HistAttrs)):
+      self.Norm[I].append(row[1+2*I]); self.Raw[I].append(row[2+2*I])
+
+class SmartHistory:  # one append only file of fixed size rows per serial, loaded into columns on the first query
+  def __init__(self, Folder):
+    self.Folder = Folder
+    self.Access = threading.Lock()
+    self.Columns = {}     # serial -> HistColumns
+    self.Last = {}        # serial -> time of the last row
+
+  def FileName(self, serial):
+    return os.path.join(self.Folder, 'smart_' + re.sub(r'[^\w.-]', '_', serial) + '.bin')
+
+  def Load(self, serial):  # call it under Access
+    cols = self.Columns.get(serial)
+    if cols != None: return cols
+    cols = HistColumns()
+    try:
+      with open(self.FileName(serial), 'rb') as f: data = f.read()
+      data = data[:len(data) // HistRowLen * HistRowLen]            # drop a torn last row
+      for row in struct.iter_unpack(HistRowFmt, data): cols.Add(row)
+    except FileNotFoundError: pass
+    self.Columns[serial] = cols
+    if len(cols.Times) > 0: self.Last[serial] = cols.Times[-1]
+    return cols
+
+  def Append(self, serial, Attrs):
+    now = int(time.time())
+    with self.Access:
+      if not (serial in self.Last): self.Load(serial)
+      if now - self.Last.get(serial, 0) < HistPeriod: return
+      values = {attr[0]: attr for attr in Attrs}
+      row = [now]
+      for attr_id in HistAttrs:
+        attr = values.get(attr_id)
+        if attr == None: row += [0, HistNone]
+        else: row += [attr[3], attr[6]]
+      try:
+        os.makedirs(self.Folder, exist_ok=True)
+        with open(self.FileName(serial), 'ab') as f: f.write(struct.pack(HistRowFmt, *row))
+      except Exception as E:
+        if Debug: print(f' SmartHistory error: {E}')
+        return
+      self.Columns[serial].Add(row); self.Last[serial] = now
+
+  def Trend(self, serial, Span, Points):  # last sample of each of the Points buckets covering the last Span seconds
+    with self.Access:
+      cols = self.Load(serial)
+      Points = max(Points, 1); Start = int(time.time()) - Span
+      Step = max(Span / Points, 1); Rows = {}
+      for I in range(len(cols.Times)):
+        if cols.Times[I] >= Start: Rows[min(int((cols.Times[I] - Start) / Step), Points - 1)] = I
+      buff = [struct.pack('<B', len(HistAttrs)), bytes(HistAttrs), struct.pack('<H', len(Rows))]
+      for bucket in sorted(Rows):
+        I = Rows[bucket]
+        buff.append(struct.pack('<I', cols.Times[I]))
+        for J in range(len(HistAttrs)): buff.append(struct.pack('<BQ', cols.Norm[J][I], cols.Raw[J][I]))
+      return b''.join(buff)
+
+
+#------ ATA Pass-Through Classes --------------------
+
+SG_IO             = 0x2285
+SG_DXFER_NONE     = -1
+SG_DXFER_FROM_DEV = -3
+SgHdrFmt          = 'iiBBHIPPPIIiPBBBBHHiII'   # struct sg_io_hdr
+sgStatus, sgSenseLen, sgHostStatus, sgDriverStatus = 13, 16, 17, 18   # sg_io_hdr output fields
+
+ataCheckPower = 0xE5      # CHECK POWER MODE: count 0x00 = standby, 0x80 = idle, 0xFF = active or idle
+ataStandbyNow = 0xE0      # STANDBY IMMEDIATE
+ataSetFeatures = 0xEF     # SET FEATURES: feature 0x05 = enable APM (level in count), 0x85 = disable APM
+ataIdentify   = 0xEC      # IDENTIFY DEVICE: 512 bytes, APM in words 83 / 86 (bit 3) and 91 (level)
+
+# AtaError codes
+ataNoDevice  = 1          # cannot open the device node
+ataNoSupport = 2          # the bridge does not pass ATA commands through
+ataAborted   = 3          # the drive aborted the command (ATA status ERR)
+ataFailed    = 4          # transport or SCSI error
+
+class AtaError(Exception):
+  def __init__(self, Code, Msg):
+    super().__init__(Msg)
+    self.Code = Code
+
+class SgTransport:        # the real thing: SG_IO ioctl on the block device node
+  def Open(self, dev_node):
+    return os.open(dev_node, os.O_RDONLY | os.O_NONBLOCK)
+
+  def Ioctl(self, fd, hdr):
+    fcntl.ioctl(fd, SG_IO, hdr, True)
+
+  def Close(self, fd):
+    os.close(fd)
+
+class FakeAtaTransport:   # SG_IO emulation, for testing without disks or on bridges we do not own ('-fakeata')
+  def __init__(self, SenseFmt=0x72, Supported=True):
+    self.SenseFmt = SenseFmt        # 0x72 descriptor or 0x70 fixed format sense
+    self.Supported = Supported      # False: behave like a bridge without SAT (ENOTTY)
+    self.Files = {}                 # fd -> dev_node
+    self.Power = {}                 # dev_node -> CHECK POWER MODE count, active if missing
+    self.APM = {}                   # dev_node -> APM level, 0x100 = disabled, 0x200 = not supported
+    self.Log = []                   # (dev_node, command, features, count) issued
+    self.NextFd = 1000
+
+  def Open(self, dev_node):
+    self.NextFd += 1; self.Files[self.NextFd] = dev_node
+    return self.NextFd
+
+  def Close(self, fd):
+    self.Files.pop(fd, None)
+
+  def Execute(self, dev_node, command, features, count, data_len):  # return: error, status, count, data
+    if command == ataCheckPower: return 0, 0x50, self.Power.get(dev_node, 0xFF), b''
+    if command == ataStandbyNow:
+      self.Power[dev_node] = 0x00; return 0, 0x50, count, b''
+    APM = self.APM.get(dev_node, 254)
+    if (command == ataSetFeatures) and (features in (0x05, 0x85)) and (APM != 0x200):
+      self.APM[dev_node] = count if features == 0x05 else 0x100
+      return 0, 0x50, count, b''
+    if command == ataIdentify:
+      words = array.array('H', bytes(512))
+      if APM != 0x200: words[83] = 0x4008; words[86] = 0x0008 if APM != 0x100 else 0; words[91] = APM & 0xFF
+      return 0, 0x50, count, words.tobytes()
+    return 0x04, 0x51, count, b''   # ABRT
+
+  def Ioctl(self, fd, hdr):
+    if not self.Supported: raise OSError(errno.ENOTTY, 'Inappropriate ioctl for device')
+    fields = list(struct.unpack(SgHdrFmt, hdr))
+    cdb = ctypes.string_at(fields[7], fields[2])
+    dev_node = self.Files[fd]
+    self.Log.append((dev_node, cdb[14], cdb[4], cdb[6]))
+    error, status, count, data = self.Execute(dev_node, cdb[14], cdb[4], cdb[6], fields[5])
+    if len(data) > 0: ctypes.memmove(fields[6], data, min(len(data), fields[5]))
+    if self.SenseFmt == 0x72:       # RECOVERED ERROR, ATA PASS-THROUGH INFORMATION AVAILABLE + ATA return descriptor
+      sense = bytes([0x72, 0x01, 0x00, 0x1D, 0, 0, 0, 14, 0x09, 0x0C, 0, error, 0, count, 0, 0, 0, 0, 0, 0, 0, status])
+    else:
+      sense = bytes([0x70, 0, 0x01, error, status, 0x40, count, 10, 0, 0, 0, 0, 0x00, 0x1D])
+    ctypes.memmove(fields[8], sense, min(len(sense), fields[3]))
+    fields[sgStatus] = 0x02; fields[sgSenseLen] = min(len(sense), fields[3])
+    hdr[:] = struct.pack(SgHdrFmt, *fields)
+
+
+#------ Instrumented Lock Class --------------------
+
+LockBuckets = 20    # log2 histogram of microseconds: [0] < 1us, [1] < 2us, ... [19] >= 262ms
+
+def LockBucket(ns):
+  return min((ns // 1000).bit_length(), LockBuckets - 1)
+
+class LockSite:
+  __slots__ = ('Count', 'WaitSum', 'HoldSum', 'WaitMax', 'HoldMax', 'WaitHist', 'HoldHist')
+
+  def __init__(self):
+    self.Count = 0
+    self.WaitSum = 0; self.HoldSum = 0      # nanoseconds
+    self.WaitMax = 0; self.HoldMax = 0
+    self.WaitHist = array.array('I', bytes(4 * LockBuckets))
+    self.HoldHist = array.array('I', bytes(4 * LockBuckets))
+
+  def Add(self, wait, hold):
+    self.Count += 1
+    self.WaitSum += wait; self.HoldSum += hold
+    if wait > self.WaitMax: self.WaitMax = wait
+    if hold > self.HoldMax: self.HoldMax = hold
+    self.WaitHist[LockBucket(wait)] += 1
+    self.HoldHist[LockBucket(hold)] += 1
+
+  def Percentile(self, hist, pct):   # upper bound of the bucket, microseconds
+    limit = self.Count * pct; total = 0
+    for I in range(LockBuckets):
+      total += hist[I]
+      if total >= limit: return 1 << I
+    return 1 << LockBuckets
+
+class InstrumentedLock:  # RLock recording wait and hold times per call site (outermost acquire only)
+  def __init__(self, Name):
+    self.Name = Name
+    self.Lock = threading.RLock()
+    self.Access = threading.Lock()
+    self.Sites = {}       # 'function:line' -> LockSite
+    self.Depth = 0        # the fields below are changed by the owner only
+    self.Site = ''
+    self.Wait = 0
+    self.Since = 0
+
+  def acquire(self, blocking=True, timeout=-1, _depth=1):
+    t0 = time.perf_counter_ns()
+    if not self.Lock.acquire(blocking, timeout): return False
+    if self.Depth == 0:
+      frame = sys._getframe(_depth)
+      self.Site = f'{frame.f_code.co_name}:{frame.f_lineno}'
+      self.Since = time.perf_counter_ns(); self.Wait = self.Since - t0
+    self.Depth += 1
+    return True
+
+  def release(self):
+    self.Depth -= 1
+    if self.Depth > 0: self.Lock.release(); return
+    hold = time.perf_counter_ns() - self.Since
+    site = self.Site; wait = self.Wait
+    self.Lock.release()
+    with self.Access:
+      stat = self.Sites.get(site)
+      if stat == None: stat = self.Sites[site] = LockSite()
+      stat.Add(wait, hold)
+
+  def __enter__(self):
+    self.acquire(_depth=2)
+    return self
+
+  def __exit__(self, *args):
+    self.release()
+
+  def Stats(self):        # return: list of (site, LockSite) sorted by total hold time
+    with self.Access: items = list(self.Sites.items())
+    items.sort(key=lambda x: x[1].HoldSum, reverse=True)
+    return items
+
+  def Pack(self):
+    items = self.Stats()
+    buff = [PackSStr(self.Name), struct.pack('<H', len(items))]
+    for site, stat in items:
+      buff.append(PackSStr(site))
+      buff.append(struct.pack('<IQQQQB', stat.Count, stat.WaitSum // 1000, stat.HoldSum // 1000, stat.WaitMax // 1000, stat.HoldMax // 1000, LockBuckets))
+      buff.append(stat.WaitHist.tobytes() + stat.HoldHist.tobytes())
+    return b''.join(buff)
+
+
 #------ BlockDev Monitor Class --------------------
 
 class BlockDevMonitor(threading.Thread):
-  def __init__(self, callback, args=None, kwargs=None):
-    import time
+  def __init__(self, callback):
     super().__init__(name='Block Devices Monitor')
-    self.loop = None
-    self.timer = FastTimer(1, callback, args, kwargs, name='Block Devices FastTimer')
+    self.callback = callback
+    self.events = {}        # sys_name -> [action, devtype, dev_node, parent_name]
+    self.mounts = False     # mount table changed
+    self.access = threading.Lock()
+    self.done_fd = os.eventfd(0)
+    self.mounts_fd = os.open('/proc/self/mounts', os.O_RDONLY)   # own file, the kernel acks changes per open file
+    self.monitor = pyudev.Monitor.from_netlink(UDEV)
+    self.monitor.filter_by('block')
+    self.monitor.start()
+    self.timer = FastTimer(1, self.Flush, name='Block Devices FastTimer')
     self.start()
-    time.sleep(0.3)
 
   def Terminate(self):
     if self.is_alive():
-      if self.loop != None: self.loop.quit()
+      os.eventfd_write(self.done_fd, 1)
       self.join()
     self.timer.Terminate()
+    os.close(self.mounts_fd)
+
+  def Flush(self):
+    with self.access:
+      events = self.events; self.events = {}
+      mounts = self.mounts; self.mounts = False
+    if (len(events) > 0) or mounts: self.callback(events, mounts)
+
+  def AddEvent(self, dev):
+    if dev.device_type not in ('disk', 'partition'): return
+    dev_node = dev.device_node
+    if dev_node == None: dev_node = dev.get('DEVNAME', '')
+    parent = os.path.basename(os.path.dirname(dev.sys_path)) if dev.device_type == 'partition' else ''
+    with self.access:
+      self.events[dev.sys_name] = [dev.action, dev.device_type, dev_node, parent]   # the last action wins
+    self.timer.Mark()
 
   def run(self):
-    import dbus
-    from dbus.mainloop.glib import DBusGMainLoop
-    from gi.repository import GLib
-
-    def sigUnitChg(*args):
-      if (len(args) >= 1) and ( args[0].startswith('blockdev@') or ('-block-' in args[0]) or (r'-by\x2dlabel-' in args[0]) ): self.timer.Mark()
-
     if Debug: print('DevMonitor thread started.')
-    DBusGMainLoop(set_as_default=True)
-    self.loop = GLib.MainLoop()
-    bus = dbus.SystemBus()
-    bus.add_signal_receiver(sigUnitChg, dbus_interface='org.freedesktop.systemd1.Manager', signal_name='UnitNew', path='/org/freedesktop/systemd1')
-    bus.add_signal_receiver(sigUnitChg, dbus_interface='org.freedesktop.systemd1.Manager', signal_name='UnitRemoved', path='/org/freedesktop/systemd1')
-
-    self.loop.run()
-    if Debug: print('DevMonitor thread ended.')
+    poll = select.poll()
+    poll.register(self.monitor.fileno(), select.POLLIN)
+    poll.register(self.done_fd, select.POLLIN)
+    poll.register(self.mounts_fd, select.POLLPRI)
+    try:
+      while True:
+        for fd, event in poll.poll():
+          if fd == self.done_fd: return
+          if fd == self.mounts_fd:
+            Mounts.Changed()
+            with self.access: self.mounts = True
+            self.timer.Mark(); continue
+          while True:
+            dev = self.monitor.poll(timeout=0)
+            if dev == None: break
+            try: self.AddEvent(dev)
+            except: pass
+    finally:
+      if Debug: print('DevMonitor thread ended.')
 
 
 #------ Permission Manager Class --------------------
@@ -793,6 +1346,974 @@ class PermissionManager:
         if len(self.TaskList) == 0: self.Done.set()
 
 
+#------ Disk Classes --------------------
+
+class DiskClass:  # disk name pattern and the power management it supports
+  __slots__ = ('Name', 'Pattern', 'Standby', 'APM')
+
+  def __init__(self, Name, Pattern, Standby, APM):
+    self.Name = Name
+    self.Pattern = re.compile(Pattern)
+    self.Standby = Standby       # keep alive, spin down and power state tracking
+    self.APM = APM               # ATA Advanced Power Management
+
+DiskClasses = [                  # append new classes here, first match wins
+  DiskClass('sd',   r'sd[a-z]+$',     True,  True),    # SATA / USB / SAS, any number of disks
+  DiskClass('nvme', r'nvme\d+n\d+$',  False, False),   # NVMe namespaces use APST, no ATA standby
+  DiskClass('mmc',  r'mmcblk\d+$',    False, False),   # SD / eMMC cards
+]
+
+def ClassifyDisk(name):  # return: the DiskClass of a data disk, None for anything else
+  if name == RootDisk: return None
+  for cls in DiskClasses:
+    if cls.Pattern.match(name): return cls
+  return None
+
+def FindRootDisk():  # name of the disk hosting the root file system, it is not a data disk
+  try:
+    st_dev = os.stat('/').st_dev
+    sys_path = os.path.realpath(f'/sys/dev/block/{os.major(st_dev)}:{os.minor(st_dev)}')
+    if os.path.exists(sys_path+'/partition'): sys_path = os.path.dirname(sys_path)
+    return os.path.basename(sys_path)
+  except: return ''
+
+def ListDisks():  # one directory read, only whole disks are listed in /sys/block
+  Disks = []
+  for name in os.listdir('/sys/block'):
+    cls = ClassifyDisk(name)
+    if cls != None: Disks.append((name, cls))
+  Disks.sort(key=lambda x: DiskOrder(x[0]))
+  return Disks
+
+def DiskOrder(name):  # sda ... sdz, sdaa ...
+  return (len(name), name)
+
+
+#------ Device Registry Classes --------------------
+
+class DevSnapshot:               # immutable registry view, published by reference: read it without devLock
+  __slots__ = ('Version', 'StructVer', 'Packed', 'Nodes', 'Serials')
+
+  def __init__(self, Version, StructVer, Packed, Nodes, Serials):
+    self.Version = Version
+    self.StructVer = StructVer
+    self.Packed = Packed         # CMD_DEVICES payload
+    self.Nodes = Nodes           # serial   -> dev_node
+    self.Serials = Serials       # dev_node -> serial
+
+class DiskStatus:
+  __slots__ = ('IOCount', 'IOTicks', 'KAStamp', 'IdleStamp', 'Token', 'State', 'StateName', 'KAS', 'SBT', 'Waking')
+
+  def __init__(self, IOCount=0, State=0, StateName='unknown', KAS=0, SBT=0):
+    self.IOCount = IOCount
+    self.IOTicks = 0
+    self.KAStamp = self.IdleStamp = time.monotonic()
+    self.Token = 0
+    self.State = State
+    self.StateName = StateName
+    self.KAS = KAS
+    self.SBT = SBT
+    self.Waking = False          # the daemon is reading the disk to spin it up
+
+  def Touch(self, now=None):     # activity: restart both KA and Idle periods
+    self.KAStamp = self.IdleStamp = time.monotonic() if now == None else now
+
+  @property
+  def KACount(self):
+    if (self.State != 1) or (self.KAS == 0): return 0
+    return int((time.monotonic() - self.KAStamp) // max(CheckPeriod, 1))
+
+  @property
+  def IdleCount(self):
+    return int((time.monotonic() - self.IdleStamp) // max(CheckPeriod, 1))
+
+class PartRec:
+  __slots__ = ('Name', 'Node', 'Label', 'UUID', 'FSType', 'Size', 'Mount')
+
+  def __init__(self, Name, Node, Label, UUID, FSType, Size, Mount):
+    self.Name = Name
+    self.Node = Node
+    self.Label = Label
+    self.UUID = UUID
+    self.FSType = FSType
+    self.Size = Size
+    self.Mount = Mount
+
+class DiskRec:
+  __slots__ = ('Name', 'Node', 'Serial', 'Size', 'Rot', 'Class', 'Stat', 'Parts', 'ApmAvail', 'Group', 'PHead', 'PStat', 'PTail', 'PSent')
+
+  def __init__(self, Name, Node, Serial, Size, Rot, Class, Stat, Parts, ApmAvail):
+    self.Name = Name
+    self.Node = Node
+    self.Serial = Serial
+    self.Size = Size
+    self.Rot = Rot
+    self.Class = Class
+    self.Stat = Stat
+    self.Parts = Parts
+    self.ApmAvail = ApmAvail
+    self.Group = ''
+    self.PHead = None            # packed name, node and serial
+    self.PStat = None            # packed status fields
+    self.PTail = None            # packed partitions
+    self.PSent = None            # status fields last sent to the app
+
+  def Managed(self):             # a HDD whose class supports keep alive and standby
+    return (self.Rot == 2) and self.Class.Standby
+
+  def PackStat(self):
+    DStat = self.Stat
+    return struct.pack('<QBBQIIB', self.Size, self.Rot, self.ApmAvail, DStat.IOCount, DStat.KACount, DStat.IdleCount, DStat.State) + PackWStr(DStat.StateName)
+
+  def PackTail(self):
+    buff = [struct.pack('<H', len(self.Parts))]
+    for part in self.Parts:
+      buff += [PackWStr(part.Name), PackWStr(part.Node), PackWStr(part.Label), PackWStr(part.UUID), PackWStr(part.FSType)]
+      buff.append(struct.pack('<QH', part.Size, len(part.Mount)))
+      for mp in part.Mount: buff.append(PackWStr(mp))
+    return b''.join(buff)
+
+class DeviceRegistry:            # use it under devLock
+  def __init__(self):
+    self.Disks = []              # sorted by device name
+    self.ByNode = {}             # dev_node  -> DiskRec
+    self.BySerial = {}           # serial    -> DiskRec
+    self.ByPart = {}             # part_node -> (DiskRec, PartRec)
+    self.PartKeys = {}           # dev_node  -> indexed part nodes
+    self.SerialKeys = {}         # dev_node  -> indexed serial
+    self.Version = 0             # bumped whenever the packed snapshot changes
+    self.StructVer = 0           # bumped whenever disks or partitions change
+    self.SentStruct = -1         # StructVer of the last snapshot sent to the app
+    self.Packed = None           # cached CMD_DEVICES snapshot
+    self.Groups = {}             # group name -> member DiskRecs, groups of two or more disks only
+    self.Snap = DevSnapshot(0, 0, struct.pack('<HH', 0, 0), {}, {})
+
+  def __len__(self):
+    return len(self.Disks)
+
+  def __iter__(self):
+    return iter(self.Disks)
+
+  def Disk(self, dev_node):
+    return self.ByNode.get(dev_node)
+
+  def DiskBySerial(self, serial):
+    return self.BySerial.get(serial) if serial != '' else None
+
+  def Part(self, part_node):
+    return self.ByPart.get(part_node, (None, None))
+
+  def Nodes(self):
+    return set(self.ByNode)
+
+  def Put(self, disk):           # add a new disk or re-index an updated one
+    old = self.ByNode.get(disk.Node)
+    if old != None:
+      self._Unindex(old)
+      if old is not disk: self.Disks[self.Disks.index(old)] = disk
+    else:
+      self.Disks.append(disk)
+      self.Disks.sort(key=lambda x: DiskOrder(x.Name))
+    self.ByNode[disk.Node] = disk
+    if disk.Serial != '': self.BySerial[disk.Serial] = disk
+    for part in disk.Parts: self.ByPart[part.Node] = (disk, part)
+    self.PartKeys[disk.Node] = [part.Node for part in disk.Parts]
+    self.SerialKeys[disk.Node] = disk.Serial
+    disk.PHead = None; self.Packed = None; self.StructVer += 1
+    self.Pack()
+
+  def Remove(self, dev_node):
+    disk = self.ByNode.get(dev_node)
+    if disk == None: return None
+    self._Unindex(disk)
+    del self.ByNode[dev_node]
+    self.Disks.remove(disk)
+    self.Packed = None; self.StructVer += 1
+    self.Pack()
+    return disk
+
+  def Pack(self):                # CMD_DEVICES snapshot, rebuilt only if a record has changed
+    for disk in self.Disks:
+      if disk.PHead == None:
+        disk.PHead = PackWStr(disk.Name) + PackWStr(disk.Node) + PackWStr(disk.Serial)
+        disk.PTail = disk.PackTail()
+        self.Packed = None
+      stat = disk.PackStat()
+      if stat != disk.PStat:
+        disk.PStat = stat; self.Packed = None
+    if self.Packed == None:
+      self.Version += 1
+      self.Packed = struct.pack('<H', len(self.Disks)) + b''.join([disk.PHead + disk.PStat + disk.PTail for disk in self.Disks]) + \
+                    self.PackGroups()
+      self.Publish()
+    return self.Packed
+
+  def PackGroups(self):          # trailing block: H count, then per group: W name, B state, H members, W member nodes
+    buff = [struct.pack('<H', len(self.Groups))]
+    for name, members in self.Groups.items():
+      States = set(disk.Stat.State for disk in members)
+      State = States.pop() if len(States) == 1 else 3       # 0 unknown, 1 active, 2 standby, 3 mixed
+      buff += [PackWStr(name), struct.pack('<BH', State, len(members))] + [PackWStr(disk.Node) for disk in members]
+    return b''.join(buff)
+
+  def SetGroups(self, Map):      # Map: dev_node -> group name
+    Groups = {}
+    for disk in self.Disks:
+      disk.Group = Map.get(disk.Node, '')
+      if disk.Group != '': Groups.setdefault(disk.Group, []).append(disk)
+    if {name: [disk.Node for disk in members] for name, members in Groups.items()} != \
+       {name: [disk.Node for disk in members] for name, members in self.Groups.items()}:
+      self.Packed = None; self.StructVer += 1
+    self.Groups = Groups
+    self.Pack()
+
+  def Publish(self):             # copy on write: readers keep the old snapshot until they fetch it again
+    Snap = self.Snap
+    if Snap.StructVer != self.StructVer:
+      Nodes = {disk.Serial: disk.Node for disk in self.Disks if disk.Serial != ''}
+      Serials = {disk.Node: disk.Serial for disk in self.Disks}
+    else: Nodes = Snap.Nodes; Serials = Snap.Serials
+    self.Snap = DevSnapshot(self.Version, self.StructVer, self.Packed, Nodes, Serials)
+
+  def PackDelta(self):           # CMD_DEVSTAT: status of the disks changed since the last sent snapshot
+    self.Pack(); items = []
+    for disk in self.Disks:
+      if disk.PStat != disk.PSent:
+        items.append(PackWStr(disk.Node) + disk.PStat)
+        disk.PSent = disk.PStat
+    if len(items) == 0: return None
+    return struct.pack('<IH', self.Version, len(items)) + b''.join(items)
+
+  def MarkSent(self, Done=True):
+    if not Done: self.SentStruct = -1; return
+    for disk in self.Disks: disk.PSent = disk.PStat
+    self.SentStruct = self.StructVer
+
+  def _Unindex(self, disk):
+    serial = self.SerialKeys.pop(disk.Node, '')
+    if self.BySerial.get(serial) is disk: del self.BySerial[serial]
+    for part_node in self.PartKeys.pop(disk.Node, []): self.ByPart.pop(part_node, None)
+
+
+#------ Disk Statistics Class --------------------
+
+# /proc/diskstats fields (after major, minor and name)
+dsReads     = 0     # reads completed
+dsRdSectors = 2     # sectors read
+dsRdTime    = 3     # time spent reading (ms)
+dsWrites    = 4     # writes completed
+dsWrSectors = 6     # sectors written
+dsWrTime    = 7     # time spent writing (ms)
+dsInFlight  = 8     # I/Os currently in progress
+dsIOTicks   = 9     # time spent doing I/Os (ms)
+dsQueueTime = 10    # weighted time spent doing I/Os (ms)
+dsFields    = 11
+
+class DiskStats:
+  def __init__(self, Count=16):
+    self.Slots = {}                                   # disk name -> slot index
+    self.Data = array.array('Q', bytes(8 * dsFields * Count))
+    self.Stamp = 0.0                                  # monotonic time of the last full read
+
+  def Slot(self, name):
+    slot = self.Slots.get(name)
+    if slot == None:
+      slot = len(self.Slots)
+      if (slot + 1) * dsFields > len(self.Data):
+        self.Data.extend(array.array('Q', bytes(8 * len(self.Data))))   # double the capacity
+      self.Slots[name] = slot
+      self.RefreshDisk(name)
+    return slot
+
+  def Refresh(self):                                  # one read of /proc/diskstats for all tracked disks
+    Slots = self.Slots; Data = self.Data
+    with open('/proc/diskstats', 'r') as f: lines = f.read().splitlines()
+    self.Stamp = time.monotonic()
+    for line in lines:
+      parts = line.split()
+      if len(parts) < dsFields + 3: continue
+      slot = Slots.get(parts[2])
+      if slot == None: continue
+      base = slot * dsFields
+      for i in range(dsFields): Data[base+i] = int(parts[3+i])
+
+  def RefreshDisk(self, name):                        # single disk, used after our own I/O
+    try:
+      with open(f'/sys/block/{name}/stat', 'r') as f: parts = f.read().split()
+      base = self.Slots[name] * dsFields
+      for i in range(dsFields): self.Data[base+i] = int(parts[i])
+    except: pass
+
+  def Get(self, name, field):
+    return self.Data[self.Slot(name) * dsFields + field]
+
+  def Ops(self, name):
+    base = self.Slot(name) * dsFields
+    return self.Data[base+dsReads] + self.Data[base+dsWrites]
+
+class DiskRates:  # CMD_RTINFO load figures, from its own diskstats samples (the standby logic keeps DStats)
+  def __init__(self):
+    self.Stats = DiskStats()
+    self.Prev = {}        # disk name -> (stamp, reads, read sectors, writes, written sectors, io ticks)
+
+  def Sample(self, name):
+    S = self.Stats; base = S.Slot(name) * dsFields; D = S.Data
+    return (S.Stamp, D[base+dsReads], D[base+dsRdSectors], D[base+dsWrites], D[base+dsWrSectors], D[base+dsIOTicks])
+
+  def Pack(self, dev_nodes):  # B count, then per disk: S node, I read B/s, I write B/s, H read IOPS, H write IOPS, H util (0.1 %)
+    for node in dev_nodes: self.Stats.Slot(node[5:])
+    try: self.Stats.Refresh()
+    except: pass
+    Items = []; Prev = {}
+    for node in dev_nodes:
+      name = node[5:]; new = self.Sample(name); old = self.Prev.get(name)
+      Prev[name] = new
+      if (old == None) or (new[0] <= old[0]): rates = (0, 0, 0, 0, 0)
+      else:
+        dt = new[0] - old[0]; d = [max(n - o, 0) for n, o in zip(new[1:], old[1:])]
+        rates = (min(int(d[1] * 512 / dt), 0xFFFFFFFF), min(int(d[3] * 512 / dt), 0xFFFFFFFF),
+                 min(round(d[0] / dt), 0xFFFF), min(round(d[2] / dt), 0xFFFF), min(round(d[4] / dt), 1000))
+      Items.append(PackSStr(node) + struct.pack('<IIHHH', *rates))
+    self.Prev = Prev
+    return struct.pack('<B', len(Items)) + b''.join(Items)
+
+
+#------ Standby Learner Class --------------------
+
+StbBins     = 40      # log spaced idle gap bins
+StbBinBase  = 30.0    # first bin edge (seconds)
+StbBinStep  = 1.3     # the last bin starts after ~3.5 days
+StbDecay    = 0.995   # the weight of the older gaps fades with every new gap
+
+class StandbyLearner:  # idle gap distribution per serial, from the DevicesTask idle -> busy transitions
+  def __init__(self, FileName):
+    self.Access = threading.Lock()
+    self.FileName = FileName
+    self.Items = {}       # serial -> array of decayed bin weights
+    self.Counts = {}      # serial -> number of gaps seen
+    self.Dirty = False
+    self.Saved = time.monotonic()
+    self.Load()
+
+  def Load(self):
+    try:
+      with open(self.FileName, 'r') as f: js = json.load(f)
+      for serial, item in js.items():
+        if len(item['bins']) == StbBins:
+          self.Items[serial] = array.array('d', item['bins']); self.Counts[serial] = item['count']
+    except FileNotFoundError: pass
+    except Exception as E:
+      if Debug: print(f' StandbyLearner load error: {E}')
+
+  def Save(self, forced=False):  # at most every 10 minutes, the gaps are hours apart anyway
+    with self.Access:
+      if not self.Dirty or (not forced and (time.monotonic() - self.Saved < 600)): return
+      js = {serial: {'bins': list(bins), 'count': self.Counts[serial]} for serial, bins in self.Items.items()}
+      self.Dirty = False; self.Saved = time.monotonic()
+    try:
+      with open(self.FileName + '.tmp', 'w') as f: json.dump(js, f)
+      os.replace(self.FileName + '.tmp', self.FileName)
+    except Exception as E:
+      if Debug: print(f' StandbyLearner save error: {E}')
+
+  def Record(self, serial, gap):
+    if (serial == '') or (gap < StbBinBase): return
+    b = min(int(math.log(gap / StbBinBase, StbBinStep)), StbBins - 1)
+    with self.Access:
+      bins = self.Items.get(serial)
+      if bins == None:
+        bins = self.Items[serial] = array.array('d', bytes(8 * StbBins)); self.Counts[serial] = 0
+      for i in range(StbBins): bins[i] *= StbDecay
+      bins[b] += 1.0; self.Counts[serial] += 1; self.Dirty = True
+
+  def Learn(self, serial, Cfg, Unit):  # return: SBT (CheckPeriod multiples) with the lowest cost, confidence (%) / None
+    with self.Access:
+      bins = self.Items.get(serial)
+      if bins == None: return None
+      bins = list(bins); N = self.Counts[serial]
+    MinSamples = Cfg.getint('MinSamples', 20)
+    IdleW = Cfg.getfloat('IdleWatts', 5.0); StbW = Cfg.getfloat('StandbyWatts', 0.8); Cycle = Cfg.getfloat('CycleCost', 1500)
+    Gaps = [StbBinBase * StbBinStep ** (i + 0.5) for i in range(StbBins)]   # geometric bin middle
+    Best = None
+    for SBT in range(max(Cfg.getint('MinSBT', 5), 1), max(Cfg.getint('MaxSBT', 120), 1) + 1):
+      T = SBT * Unit; Cost = 0.0
+      for gap, w in zip(Gaps, bins):
+        if w == 0: continue
+        if gap <= T: Cost += w * gap * IdleW                            # it stays spinning through the gap
+        else: Cost += w * (T * IdleW + (gap - T) * StbW + Cycle)        # spins down, then a full spin cycle
+      if (Best == None) or (Cost < Best[1]): Best = (SBT, Cost)
+    if Best == None: return None
+    return Best[0], round(100 * N / (N + MinSamples)), N >= MinSamples
+
+  def Pack(self, Cfg, Unit):  # I count, then per disk: S serial, I learned SBT, I gaps seen, B confidence (%)
+    with self.Access: Serials = list(self.Items)
+    Items = []
+    for serial in Serials:
+      Res = self.Learn(serial, Cfg, Unit)
+      if Res != None: Items.append(PackSStr(serial) + struct.pack('<IIB', Res[0], self.Counts[serial], Res[1]))
+    return struct.pack('<I', len(Items)) + b''.join(Items)
+
+
+#------ Access Predictor Class --------------------
+
+class AccessRec:
+  __slots__ = ('Prob', 'Accessed', 'Target', 'Until', 'Prespins', 'Hits', 'Misses', 'Stalls')
+
+  def __init__(self, Prob=None, Stats=(0, 0, 0, 0)):
+    self.Prob = array.array('d', Prob if Prob != None else bytes(8 * 168))   # access odds per weekday hour
+    self.Accessed = False   # accessed during the current hour
+    self.Target = -1        # absolute hour of the last pre-spin
+    self.Until = 0          # a pre-spin waits for an access until this time, 0 = none pending
+    self.Prespins, self.Hits, self.Misses, self.Stalls = Stats
+
+class AccessPredictor:  # weekday/hour access odds per serial, disks are woken a Lead time before a likely hour
+  def __init__(self, FileName):
+    self.Access = threading.Lock()
+    self.FileName = FileName
+    self.Items = {}       # serial -> AccessRec
+    self.Hour = None      # absolute local hour being observed
+    self.Dirty = False
+    self.Saved = time.monotonic()
+    try:
+      with open(FileName, 'r') as f: js = json.load(f)
+      for serial, item in js.items():
+        if len(item['prob']) == 168: self.Items[serial] = AccessRec(item['prob'], tuple(item['stats']))
+    except FileNotFoundError: pass
+    except Exception as E:
+      if Debug: print(f' AccessPredictor load error: {E}')
+
+  def Save(self, forced=False):
+    with self.Access:
+      if not self.Dirty or (not forced and (time.monotonic() - self.Saved < 600)): return
+      js = {serial: {'prob': list(rec.Prob), 'stats': [rec.Prespins, rec.Hits, rec.Misses, rec.Stalls]} for serial, rec in self.Items.items()}
+      self.Dirty = False; self.Saved = time.monotonic()
+    try:
+      with open(self.FileName + '.tmp', 'w') as f: json.dump(js, f)
+      os.replace(self.FileName + '.tmp', self.FileName)
+    except Exception as E:
+      if Debug: print(f' AccessPredictor save error: {E}')
+
+  @staticmethod
+  def Slot(ts):  # return: absolute local hour, weekday hour slot
+    LT = time.localtime(ts)
+    return int((ts + LT.tm_gmtoff) // 3600), LT.tm_wday * 24 + LT.tm_hour
+
+  def Rec(self, serial):  # call it under Access
+    rec = self.Items.get(serial)
+    if rec == None: rec = self.Items[serial] = AccessRec()
+    return rec
+
+  def Touch(self, serial, Sleeping, now):  # an access: a pre-spin hit, or a stall if the disk was in standby
+    if serial == '': return                 # the pre-spin read itself never gets here, its disk is Waking
+    with self.Access:
+      rec = self.Rec(serial); rec.Accessed = True
+      if Sleeping: rec.Stalls += 1          # the pre-spin did not wake it (yet): no hit
+      elif rec.Until > 0: rec.Hits += 1; rec.Until = 0
+      self.Dirty = True
+
+  def Tick(self, Disks, now, Cfg):  # Disks: (serial, dev_node, in standby) / return: dev nodes to wake
+    Decay = Cfg.getfloat('Decay', 0.8); Lead = Cfg.getint('Lead', 120); Thr = Cfg.getfloat('Threshold', 0.5)
+    Hour, Slot = self.Slot(time.time())
+    Wake = []
+    with self.Access:
+      if self.Hour == None: self.Hour = Hour
+      elif Hour != self.Hour:                  # the hour is over: update its odds for every present disk
+        Done = self.Slot(time.time() - 3600)[1] if Hour == self.Hour + 1 else None
+        for serial, node, Sleeping in Disks:
+          rec = self.Rec(serial)
+          if Done != None: rec.Prob[Done] = rec.Prob[Done] * Decay + (1 - Decay) * rec.Accessed
+          rec.Accessed = False
+        self.Hour = Hour; self.Dirty = True
+      for serial, node, Sleeping in Disks:
+        rec = self.Rec(serial)
+        if (rec.Until > 0) and (now >= rec.Until):
+          rec.Misses += 1; rec.Until = 0; self.Dirty = True
+        if not Cfg.getboolean('Enabled') or not Sleeping: continue
+        Target, TSlot = self.Slot(time.time() + Lead)
+        if (Target != Hour) and (Target != rec.Target) and (rec.Prob[TSlot] >= Thr):
+          rec.Target = Target; rec.Until = now + Lead + 3600; rec.Prespins += 1
+          Wake.append(node)
+    return Wake
+
+  def Pack(self):  # I count, then per disk: S serial, I pre-spins, I hits, I misses, I stalls (standby wakes not predicted)
+    with self.Access:
+      Items = [PackSStr(serial) + struct.pack('<IIII', rec.Prespins, rec.Hits, rec.Misses, rec.Stalls) for serial, rec in self.Items.items()]
+    return struct.pack('<I', len(Items)) + b''.join(Items)
+
+
+#------ Wear Ledger Class --------------------
+
+class WearRec:
+  __slots__ = ('SpinDowns', 'SpinUps', 'SpinSec', 'StbSec', 'State', 'Stamp', 'SmartBase', 'SmartLast')
+
+  def __init__(self, Data=None):
+    if Data == None: Data = {}
+    self.SpinDowns = Data.get('downs', 0)
+    self.SpinUps = Data.get('ups', 0)
+    self.SpinSec = Data.get('spin', 0.0)
+    self.StbSec = Data.get('standby', 0.0)
+    self.SmartBase = Data.get('smart_base')   # [Start_Stop_Count, Load_Cycle_Count, our spin-ups, our spin-downs], each pair at the first valid sample
+    self.SmartLast = Data.get('smart_last')   # [Start_Stop_Count, Load_Cycle_Count] of the last SMART sample
+    self.State = 0        # last observed state, the time in it is not yet counted
+    self.Stamp = 0
+
+  def Dump(self):
+    return {'downs': self.SpinDowns, 'ups': self.SpinUps, 'spin': self.SpinSec, 'standby': self.StbSec,
+            'smart_base': self.SmartBase, 'smart_last': self.SmartLast}
+
+class WearLedger:  # spin cycles and time per state per serial, sampled by DevicesTask, checked against SMART
+  def __init__(self, FileName):
+    self.Access = threading.Lock()
+    self.FileName = FileName
+    self.Items = {}       # serial -> WearRec
+    self.Dirty = False
+    self.Saved = time.monotonic()
+    try:
+      with open(FileName, 'r') as f: js = json.load(f)
+      for serial, item in js.items(): self.Items[serial] = WearRec(item)
+    except FileNotFoundError: pass
+    except Exception as E:
+      if Debug: print(f' WearLedger load error: {E}')
+
+  def Save(self, forced=False):
+    with self.Access:
+      if not self.Dirty or (not forced and (time.monotonic() - self.Saved < 600)): return
+      js = {serial: rec.Dump() for serial, rec in self.Items.items()}
+      self.Dirty = False; self.Saved = time.monotonic()
+    try:
+      with open(self.FileName + '.tmp', 'w') as f: json.dump(js, f)
+      os.replace(self.FileName + '.tmp', self.FileName)
+    except Exception as E:
+      if Debug: print(f' WearLedger save error: {E}')
+
+  def Observe(self, serial, State, now):  # State: 0 unknown, 1 spinning, 2 standby
+    with self.Access:
+      rec = self.Items.get(serial)
+      if rec == None: rec = self.Items[serial] = WearRec()
+      if rec.State == 1: rec.SpinSec += now - rec.Stamp
+      elif rec.State == 2: rec.StbSec += now - rec.Stamp
+      if (rec.State == 1) and (State == 2): rec.SpinDowns += 1
+      elif (rec.State == 2) and (State == 1): rec.SpinUps += 1
+      rec.State = State; rec.Stamp = now; self.Dirty = True
+
+  def Drop(self, serial):  # the disk left: the time until it comes back is not counted in any state
+    with self.Access:
+      rec = self.Items.get(serial)
+      if rec != None: rec.State = 0
+
+  def Smart(self, serial, Attrs):  # raw Start_Stop_Count (4) and Load_Cycle_Count (193) from a SMART sample
+    Raw = {attr[0]: attr[6] for attr in Attrs}
+    Vals = [Raw.get(4, -1), Raw.get(193, -1)]
+    with self.Access:
+      rec = self.Items.get(serial)
+      if rec == None: rec = self.Items[serial] = WearRec()
+      if rec.SmartBase == None: rec.SmartBase = [-1, -1, 0, 0]
+      Ours = [rec.SpinUps, rec.SpinDowns]
+      for i in range(2):                      # Start_Stop_Count goes with our spin-ups, Load_Cycle_Count with our spin-downs
+        if (rec.SmartBase[i] < 0) and (Vals[i] >= 0): rec.SmartBase[i] = Vals[i]; rec.SmartBase[i + 2] = Ours[i]
+      rec.SmartLast = Vals; self.Dirty = True
+
+  def Pack(self, Cfg):  # I count, then per disk: S serial, I spin-downs, I spin-ups, Q seconds spinning, Q seconds in standby,
+                        # d energy saved (Wh), i SMART start/stop delta, i SMART load cycle delta (-1 = unknown),
+                        # I spin-ups and I spin-downs counted here since the matching SMART baseline (0 = none yet)
+    SavedW = Cfg.getfloat('IdleWatts', 5.0) - Cfg.getfloat('StandbyWatts', 0.8); SpinUpWs = Cfg.getfloat('SpinUpWs', 150)
+    Items = []
+    with self.Access:
+      for serial, rec in self.Items.items():
+        Saved = (rec.StbSec * SavedW - rec.SpinUps * SpinUpWs) / 3600
+        Delta = [-1, -1]; Ours = [0, 0]
+        if (rec.SmartBase != None) and (rec.SmartLast != None):
+          Counted = [rec.SpinUps, rec.SpinDowns]
+          for i in range(2):
+            if rec.SmartBase[i] < 0: continue
+            Ours[i] = Counted[i] - rec.SmartBase[i + 2]
+            if rec.SmartLast[i] >= 0: Delta[i] = rec.SmartLast[i] - rec.SmartBase[i]
+        Items.append(PackSStr(serial) + struct.pack('<IIQQdiiII', rec.SpinDowns, rec.SpinUps, int(rec.SpinSec), int(rec.StbSec),
+                                                    Saved, Delta[0], Delta[1], Ours[0], Ours[1]))
+    return struct.pack('<I', len(Items)) + b''.join(Items)
+
+
+#------ Wake Attribution Classes --------------------
+
+TraceRoots = ('/sys/kernel/tracing', '/sys/kernel/debug/tracing')
+TraceLine = re.compile(r'^\s*(.*)-(\d+)\s+.*block_rq_issue: (\d+),(\d+) ')
+
+def TraceOwnerAlive():  # return: True if another running daemon owns the tracefs instance
+  try:
+    with open(TracePidFile, 'r') as f: pid = int(f.read())
+    return (pid != os.getpid()) and (os.path.basename(__file__) in ' '.join(psutil.Process(pid).cmdline()))
+  except: return False
+
+class BlockTrace(threading.Thread):  # block_rq_issue in a private tracefs instance: who issued each request, per device
+  def __init__(self):
+    super().__init__(name='Block Trace')
+    self.daemon = True
+    self.Access = threading.Lock()
+    self.Recent = {}      # 'major:minor' -> [(monotonic, comm)], newest last
+    self.EndFlag = threading.Event()
+    self.Path = None; self.fd = -1
+    self.Active = False   # block_rq_issue enabled
+    if TraceOwnerAlive():
+      if Debug: print(' BlockTrace: the instance belongs to a running daemon')
+      return
+    for root in TraceRoots:
+      if os.path.isdir(root + '/instances'):
+        try:
+          self.Path = root + '/instances/nas_wakers'
+          if not os.path.isdir(self.Path): os.mkdir(self.Path)
+          with open(self.Path + '/events/block/block_rq_issue/enable', 'w') as f: f.write('0')   # SetActive turns it on
+          self.fd = os.open(self.Path + '/trace_pipe', os.O_RDONLY | os.O_NONBLOCK)
+          with open(TracePidFile, 'w') as f: f.write(str(os.getpid()))
+          break
+        except Exception as E:
+          if Debug: print(f' BlockTrace error: {E}')
+          self.Close(); self.Path = None
+    if self.fd >= 0: self.start()
+
+  def Available(self):
+    return self.fd >= 0
+
+  def SetActive(self, On):  # only while a managed disk sleeps, no request is parsed otherwise
+    if (self.Path == None) or (On == self.Active): return
+    try:
+      with open(self.Path + '/events/block/block_rq_issue/enable', 'w') as f: f.write('1' if On else '0')
+      self.Active = On
+    except Exception as E:
+      if Debug: print(f' BlockTrace error: {E}')
+
+  def run(self):
+    Poll = select.poll(); Poll.register(self.fd, select.POLLIN); Rest = b''
+    try:
+      while not self.EndFlag.is_set():
+        if len(Poll.poll(1000)) == 0: continue
+        try: Rest += os.read(self.fd, 65536)
+        except BlockingIOError: continue
+        *Lines, Rest = Rest.split(b'\n'); now = time.monotonic()
+        with self.Access:
+          for line in Lines:
+            match = TraceLine.match(line.decode('utf-8', 'replace'))
+            if match == None: continue
+            items = self.Recent.setdefault(f'{match.group(3)}:{match.group(4)}', [])
+            items.append((now, match.group(1).strip()))
+            if len(items) > 256: del items[:128]
+    finally: self.Close()
+
+  def Issuers(self, dev, since):  # return: {comm: requests} issued to the device since the given time
+    Res = {}
+    with self.Access:
+      for stamp, comm in self.Recent.get(dev, []):
+        if stamp >= since: Res[comm] = Res.get(comm, 0) + 1
+    return Res
+
+  def Close(self):  # from run() and Terminate(), whichever comes first
+    with self.Access:
+      if self.fd >= 0:
+        try: os.close(self.fd)
+        except: pass
+        self.fd = -1
+      if self.Path != None:
+        try:
+          with open(self.Path + '/events/block/block_rq_issue/enable', 'w') as f: f.write('0')
+          os.rmdir(self.Path)
+        except: pass
+        try: os.remove(TracePidFile)
+        except: pass
+        self.Path = None
+
+  def Terminate(self):
+    self.EndFlag.set()
+    if self.is_alive(): self.join(2)   # run() wakes up from poll within a second
+    self.Close()                       # the instance must not outlive us, even if run() is stuck
+
+def ReadProcIO():  # return: {pid: (comm, bytes read + written from storage)}
+  Res = {}
+  for pid in os.listdir('/proc'):
+    if not pid.isdigit(): continue
+    try:
+      with open(f'/proc/{pid}/io', 'r') as f: Lines = f.read().splitlines()
+      with open(f'/proc/{pid}/comm', 'r') as f: comm = f.read().strip()
+      Vals = dict(line.split(': ') for line in Lines)
+      Res[pid] = (comm, int(Vals['read_bytes']) + int(Vals['write_bytes']))
+    except: continue
+  return Res
+
+class WakeTracer:  # who made a sleeping disk spin up: tracepoints if possible, /proc/<pid>/io deltas otherwise
+  def __init__(self):
+    Cfg = Config['Wakers']
+    self.Enabled = Cfg.getboolean('Enabled') and not HookMode
+    self.Top = Cfg.getint('Top', 5)
+    self.UseTrace = self.Enabled and Cfg.getboolean('Trace')
+    self.Trace = None     # BlockTrace, created by Start
+    self.Prev = None      # the last ReadProcIO snapshot
+    self.SnapAt = 0
+    self.Stamp = 0
+    self.Access = threading.Lock()
+    self.Rank = {}        # (dev_node, comm) -> [wakes, last wake (wall time)]
+
+  def Start(self):  # daemon mode only, after the single instance check
+    if self.UseTrace and (self.Trace == None): self.Trace = BlockTrace()
+
+  def Round(self, Woken, Asleep):  # after every DevicesTask round, outside devLock / Woken: disks that left standby
+    if not self.Enabled: return
+    if not Asleep and (len(Woken) == 0):
+      self.Prev = None
+      if self.Trace != None: self.Trace.SetActive(False)
+      return
+    Traced = (self.Trace != None) and self.Trace.Available()
+    Since = self.Stamp; self.Stamp = time.monotonic(); Snap = None
+    if not Traced and ((len(Woken) > 0) or (self.Stamp - self.SnapAt >= CheckPeriod)):
+      Snap = ReadProcIO()                   # walks all of /proc: only on a wake, or once per check period
+    for dev_node in Woken:
+      Top = None
+      if Traced and (Since > 0):
+        try:
+          with open(f'/sys/block/{dev_node[5:]}/dev', 'r') as f: dev = f.read().strip()
+          Top = sorted(self.Trace.Issuers(dev, Since - 1).items(), key=lambda x: -x[1])[:self.Top]
+          Desc = [f'{comm} ({count} req)' for comm, count in Top]
+        except: Top = None
+      if not Top and (Snap != None) and (self.Prev != None):   # no trace: processes that did storage I/O meanwhile, any disk
+        Delta = {}
+        for pid, (comm, total) in Snap.items():
+          old = self.Prev.get(pid)
+          if (old != None) and (total > old[1]): Delta[comm] = Delta.get(comm, 0) + total - old[1]
+        Top = sorted(Delta.items(), key=lambda x: -x[1])[:self.Top]
+        Desc = [f'{comm} ({size // 1024} KiB)' for comm, size in Top]
+      if not Top: Top = [('unknown', 0)]; Desc = ['unknown']
+      with self.Access:
+        item = self.Rank.setdefault((dev_node, Top[0][0]), [0, 0])
+        item[0] += 1; item[1] = int(time.time())
+      Msg = f'{dev_node} left standby, top I/O: ' + ', '.join(Desc)
+      if Debug: print(Msg)
+      else: SendMessageToLog(Msg)
+    if Snap != None: self.Prev = Snap; self.SnapAt = self.Stamp
+    if self.Trace != None: self.Trace.SetActive(Asleep)   # after the issuers of this round were read
+
+  def Pack(self):  # I count, then ranked by wakes: S dev node, S process, I wakes, Q last wake (unix time)
+    with self.Access: Items = sorted(self.Rank.items(), key=lambda x: -x[1][0])
+    return struct.pack('<I', len(Items)) + b''.join([PackSStr(node) + PackSStr(comm) + struct.pack('<IQ', *val) for (node, comm), val in Items])
+
+  def Terminate(self):
+    if self.Trace != None: self.Trace.Terminate()
+
+
+#------ Disk Latency Monitor Class --------------------
+
+def Percentiles(Values):  # return: p50, p95, p99
+  data = sorted(Values); Count = len(data)
+  return tuple(data[min(int(Count * q), Count - 1)] for q in (0.50, 0.95, 0.99))
+
+class LatencyRec:
+  __slots__ = ('Prev', 'Await', 'Svc', 'Stamp', 'Pos', 'Count', 'First', 'Last', 'Base', 'SlowSince', 'Alert')
+
+  def __init__(self, Size, Prev):
+    self.Prev = Prev                            # (ops, ms spent in I/Os, io ticks) of the last sample
+    self.Await = array.array('f', bytes(4 * Size))   # ms per op, ring buffer
+    self.Svc = array.array('f', bytes(4 * Size))
+    self.Stamp = array.array('d', bytes(8 * Size))   # monotonic time of each sample, idle polls add none
+    self.Pos = 0
+    self.Count = 0
+    self.First = None                           # time of the first busy sample
+    self.Last = None                            # time of the last busy sample
+    self.Base = None                            # slow moving p50 await, None while the first window fills
+    self.SlowSince = None
+    self.Alert = False
+
+  def Add(self, Await, Svc, now):
+    self.Await[self.Pos] = Await; self.Svc[self.Pos] = Svc; self.Stamp[self.Pos] = now
+    self.Pos = (self.Pos + 1) % len(self.Await)
+    self.Count = min(self.Count + 1, len(self.Await))
+    if self.First == None: self.First = now
+    self.Last = now
+
+  def Recent(self, since):  # return: await and service time lists of the samples taken since the given time
+    idx = [i for i in range(self.Count) if self.Stamp[i] >= since]
+    return [self.Await[i] for i in idx], [self.Svc[i] for i in idx]
+
+class LatencyMonitor:  # use it under devLock, fed from the DStats sample DevicesTask has just taken
+  def __init__(self):
+    Cfg = Config['Latency']
+    self.Window = Cfg.getint('Window', 300)     # seconds of busy samples the percentiles are taken over
+    self.Size = max(self.Window // DiskPollPeriod, 10)   # ring capacity: one sample per poll at most
+    self.Factor = Cfg.getfloat('Factor', 4)
+    self.MinAwait = Cfg.getfloat('MinAwait', 50)
+    self.Hold = Cfg.getint('Hold', 60)
+    self.Items = {}       # dev_node -> LatencyRec
+
+  def Update(self, disk, now):  # return: [MsgCode, LID, Params] when the disk turns slow or recovers, else None
+    name = disk.Name
+    cur = (DStats.Ops(name), DStats.Get(name, dsRdTime) + DStats.Get(name, dsWrTime), DStats.Get(name, dsIOTicks))
+    rec = self.Items.get(disk.Node)
+    if rec == None:
+      self.Items[disk.Node] = LatencyRec(self.Size, cur); return None
+    ops = cur[0] - rec.Prev[0]; spent = cur[1] - rec.Prev[1]; ticks = cur[2] - rec.Prev[2]
+    rec.Prev = cur
+    if (ops <= 0) or (spent < 0) or (ticks < 0): return None   # idle, or the counters were reset
+    if (rec.Last != None) and (now - rec.Last > self.Hold): rec.SlowSince = None   # it did not stay slow across the gap
+    rec.Add(spent / ops, ticks / ops, now)
+    if now - rec.First < self.Window: return None
+    Awaits, Svcs = rec.Recent(now - self.Window)
+    if len(Awaits) < 10: return None            # too few busy samples in the window
+    p50, p95, p99 = Percentiles(Awaits)
+    if rec.Base == None: rec.Base = p50; return None
+    Limit = max(rec.Base * self.Factor, self.MinAwait)
+    if p50 > Limit:
+      if rec.SlowSince == None: rec.SlowSince = now
+      if not rec.Alert and (now - rec.SlowSince >= self.Hold):
+        rec.Alert = True
+        return [SlowDisk1Msg, 3, [disk.Node, f'{p50:.0f}', f'{p95:.0f}', f'{p99:.0f}', f'{rec.Base:.1f}']]
+      return None
+    rec.SlowSince = None
+    if rec.Alert:
+      if p50 > Limit / 2: return None           # hysteresis
+      rec.Alert = False
+      return [SlowDisk0Msg, 1, [disk.Node, f'{p50:.0f}']]
+    rec.Base += (p50 - rec.Base) / self.Size    # the baseline only follows healthy windows
+    return None
+
+  def Stats(self, dev_node):  # return: (await p50, p95, p99), (service time p50, p95, p99) or None
+    rec = self.Items.get(dev_node)
+    if rec == None: return None
+    Awaits, Svcs = rec.Recent(time.monotonic() - self.Window)
+    if len(Awaits) == 0: return None
+    return Percentiles(Awaits), Percentiles(Svcs)
+
+  def Drop(self, dev_node):
+    self.Items.pop(dev_node, None)
+
+
+#------ Disk Scheduler Class --------------------
+
+class DiskScheduler:  # use it under devLock
+  def __init__(self):
+    self.Heap = []        # (deadline, token, dev_node), lazily invalidated by DiskStatus.Token
+    self.Seq = 0
+
+  def Deadline(self, disk):  # next keep alive or standby time of an active HDD, None if nothing to do
+    DStat = disk.Stat
+    if not disk.Managed() or (DStat.State != 1): return None
+    Unit = max(CheckPeriod, 1); deadline = None
+    if DStat.KAS > 0: deadline = DStat.KAStamp + DStat.KAS * Unit
+    if DStat.SBT > 0:
+      sb_time = DStat.IdleStamp + DStat.SBT * Unit
+      if (deadline == None) or (sb_time < deadline): deadline = sb_time
+    return deadline
+
+  def Schedule(self, disk):
+    self.Seq += 1; disk.Stat.Token = self.Seq
+    deadline = self.Deadline(disk)
+    if deadline != None: heapq.heappush(self.Heap, (deadline, self.Seq, disk.Node))
+    if len(self.Heap) > 4 * len(DevReg) + 16:                  # drop the stale entries
+      self.Heap = [entry for entry in self.Heap if self.Valid(entry) != None]
+      heapq.heapify(self.Heap)
+
+  def Valid(self, entry):
+    disk = DevReg.Disk(entry[2])
+    return disk if (disk != None) and (disk.Stat.Token == entry[1]) else None
+
+  def Next(self):
+    while (len(self.Heap) > 0) and (self.Valid(self.Heap[0]) == None): heapq.heappop(self.Heap)
+    return self.Heap[0][0] if len(self.Heap) > 0 else None
+
+  def Due(self, now):
+    Disks = []
+    while (len(self.Heap) > 0) and (self.Heap[0][0] <= now):
+      disk = self.Valid(heapq.heappop(self.Heap))
+      if disk != None: Disks.append(disk)
+    return Disks
+
+
+#------ Static Properties Cache Class --------------------
+
+class BlockProps:  # properties of a disk or partition that never change while it is plugged in
+  __slots__ = ('Serial', 'Size', 'Rot', 'Label', 'UUID', 'FSType')
+
+  def __init__(self, dev, is_disk):
+    self.Serial = dev.get('ID_SERIAL_SHORT', '')
+    self.Size   = SysfsSize(dev.sys_name)
+    self.Rot    = RotationalDisk(dev.sys_name) if is_disk else 0
+    self.Label  = dev.get('ID_FS_LABEL', '')
+    self.UUID   = dev.get('ID_FS_UUID', '')
+    self.FSType = dev.get('ID_FS_TYPE', '')
+
+class PropsCache:  # keyed by (serial, dev_t), dropped only by udev change / remove events
+  def __init__(self):
+    self.Access = threading.Lock()
+    self.Items = {}       # (serial, dev_t) -> BlockProps
+    self.Names = {}       # sys_name -> [(serial, dev_t), parent disk name]
+
+  def Get(self, dev, parent=''):
+    key = (dev.get('ID_SERIAL_SHORT', ''), dev.device_number)
+    with self.Access: props = self.Items.get(key)
+    if props == None:
+      props = BlockProps(dev, parent == '')
+      with self.Access:
+        self.Items[key] = props
+        self.Names[dev.sys_name] = [key, parent]
+    return props
+
+  def Invalidate(self, name):  # a disk takes its partitions with it
+    with self.Access:
+      for item in [item for item, (key, parent) in self.Names.items() if (item == name) or (parent == name)]:
+        key, parent = self.Names.pop(item)
+        self.Items.pop(key, None)
+
+
+#------ Mount Table Class --------------------
+
+def MntUnescape(field):  # mountinfo escapes space, tab, newline and backslash as octal
+  if not '\\' in field: return field
+  return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+class MountTable:  # mountinfo index, reloaded only when the kernel reports a mount table change
+  def __init__(self):
+    self.Access = threading.Lock()
+    self.ByNode = {}      # device node -> [folder, path, fstype, opts] of its first mount
+    self.ByPath = {}      # mount path -> (source, fstype, maj:min)
+    self.Dirty = True
+    self.Version = 0
+    self.fd = os.open('/proc/self/mounts', os.O_RDONLY)
+    self.poll = select.poll()
+    self.poll.register(self.fd, select.POLLPRI)
+
+  def Changed(self):      # the kernel reports POLLERR | POLLPRI once for every change
+    self.Dirty = True
+
+  def Refresh(self):      # return: True if the table was reloaded
+    with self.Access:
+      if self.poll.poll(0): self.Dirty = True
+      if not self.Dirty: return False
+      self.Dirty = False
+      ByNode = {}; ByPath = {}
+      with open('/proc/self/mountinfo', 'r') as f: lines = f.read().splitlines()
+      for line in lines:
+        left, sep, right = line.partition(' - ')
+        left = left.split(); right = right.split()
+        if (len(left) < 6) or (len(right) < 2): continue
+        path = MntUnescape(left[4]); fstype = right[0]; source = MntUnescape(right[1])
+        ByPath[path] = (source, fstype, left[2])
+        if not source.startswith('/dev/'): continue
+        node = os.path.realpath(source)
+        if node in ByNode: continue
+        opts = left[5].split(',')
+        if len(right) > 2: opts += [opt for opt in right[2].split(',') if (opt not in ('rw', 'ro')) and (opt not in opts)]
+        folder = path if path == '/' else path.rsplit('/',1)[-1]
+        ByNode[node] = [folder, path, fstype, ','.join(opts)]
+      self.ByNode = ByNode; self.ByPath = ByPath
+      self.Version += 1
+      return True
+
+  def Node(self, dev_node):
+    self.Refresh()
+    mount = self.ByNode.get(dev_node)
+    return [] if mount == None else list(mount)
+
+  def Path(self, mpoint):
+    self.Refresh()
+    return self.ByPath.get(os.path.normpath(mpoint))
+
+  def Mounted(self, mpoint):
+    return self.Path(mpoint) != None
+
 #------ Hardware PWM Class --------------------
 
 # pwm0 is GPIO pin 18 is physical pin 32 (dtoverlay can be deployed to use GPIO 12 instead)
@@ -899,7 +2420,7 @@ def ShutdownType():
     else: return 'RS-UPS', 10
   except: return 'RS-UPS', 10
 
-def SignalToCutThePower():
+def SignalToCutThePower():  # only after the disks are parked: the Pico may cut the power as soon as it gets the command
   try:
     SDType, RSecs = ShutdownType()
     I2CBus = SMBus(1)
@@ -923,24 +2444,39 @@ def SignalToCutThePower():
     request.set_value(SDReadyPin, gpiod.line.Value.ACTIVE)
     time.sleep(1)
 
-def PowerOffHDDs():
+def PowerOffHDDs(Deadline):  # all disks are parked at once, then polled until they report standby
   disks = []
-  for dev in UDEV.list_devices(subsystem='block', DEVTYPE='disk'):
-    if re.match(r'sd[a-z]$', dev.sys_name) and RotationalDisk(dev.sys_name):
-      disks.append([dev.sys_name, dev.device_node])
+  for name, cls in ListDisks():
+    if cls.Standby and (RotationalDisk(name) == 2):
+      disks.append([name, '/dev/'+name])
   if len(disks) == 0: return
-  disks.sort(key=lambda x: x[0])
-  devices = ', '.join([disk[0] for disk in disks]); AllOK = True
-  for disk in disks: KeepAlive(disk[1])
-  time.sleep(5)
-  for disk in disks:
-    cmd = ['sudo', '/usr/sbin/hdparm', '-y', disk[1]]
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if AllOK and result.returncode != 0:
-      AllOK = False; ErrMsg1 = disk[1]; ErrMsg2 = result.stderr
-  if AllOK: BroadcastMsg(HddPark1Msg, 1, [devices])
-  else: BroadcastMsg(HddPark0Msg, 3, [ErrMsg1, ErrMsg2])
-  time.sleep(8)
+  devices = ', '.join([disk[0] for disk in disks]); ErrMsg = None
+  nodes = [disk[1] for disk in disks]
+  Awake = [node for node, Active in zip(nodes, AtaForAll(nodes, IsDriveActive)) if Active != False]
+  KASrv.KeepAlive(Awake, max(Deadline - time.monotonic(), 0) / 3, Awake=True)   # parked disks are not spun up again
+  Errors = AtaForAll(nodes, StandbyDisk)
+  for node, Err in zip(nodes, Errors):
+    if (ErrMsg == None) and (Err != ''): ErrMsg = [node, Err]
+  Pending = [node for node, Err in zip(nodes, Errors) if Err == '']
+  while len(Pending) > 0:
+    Pending = [node for node, Active in zip(Pending, AtaForAll(Pending, IsDriveActive)) if Active]
+    if (len(Pending) == 0) or (time.monotonic() + 0.25 > Deadline): break
+    time.sleep(0.25)
+  if (ErrMsg == None) and (len(Pending) > 0): ErrMsg = [Pending[0], 'the disk did not reach standby in time']
+  if ErrMsg == None: BroadcastMsg(HddPark1Msg, 1, [devices])
+  else: BroadcastMsg(HddPark0Msg, 3, ErrMsg)
+
+def RunShutdownHook(MsgCode, LID, CutPower):  # every step runs against one deadline, the power cut never waits for a straggler
+  global PushTimeout
+  Deadline = time.monotonic() + ShutdownBudget
+  PushTimeout = HookPushTimeout
+  Jobs = [threading.Thread(target=PowerOffHDDs, args=(Deadline - 1,), daemon=True),
+          threading.Thread(target=BroadcastMsg, args=(MsgCode, LID), daemon=True)]
+  for job in Jobs: job.start()
+  for job in Jobs: job.join(max(Deadline - 1 - time.monotonic(), 0))   # 1 second is kept for the steps below
+  SaveAndroMsgPool()
+  SendBuff(CMD_THEEND, b'', False, False)
+  if CutPower: SignalToCutThePower()                                   # the Pico is told only when parking is over
 
   
 def SetSafeShd():
@@ -1006,16 +2542,27 @@ def FormatBytes(data):
   return ' '.join(['{:02x}'.format(byte) for byte in data]).upper()
 
 def ShowStatInfo():
-  for disk in DevList:
-    print(f'{rPad(disk[0]+" =", 8)} IO: {rPad(disk[5][0], 10)} KA: {rPad(disk[5][1], 5)} Idle: {rPad(disk[5][2], 5)} State: {disk[5][4]}  {disk[5][5]}/{disk[5][6]}')
+  for disk in DevReg:
+    DStat = disk.Stat
+    print(f'{rPad(disk.Name+" =", 8)} IO: {rPad(DStat.IOCount, 10)} KA: {rPad(DStat.KACount, 5)} Idle: {rPad(DStat.IdleCount, 5)} State: {DStat.StateName}  {DStat.KAS}/{DStat.SBT}')
+    Lat = Latency.Stats(disk.Node)
+    if Lat != None: print(f'{" " * 8} await p50/p95/p99: {Lat[0][0]:.1f}/{Lat[0][1]:.1f}/{Lat[0][2]:.1f} ms  svctm: {Lat[1][0]:.1f}/{Lat[1][1]:.1f}/{Lat[1][2]:.1f} ms')
+  print('')
+
+def ShowLockStats():
+  for lock in (devLock, cfgLock):
+    for site, stat in lock.Stats():
+      print(f'{rPad(lock.Name, 8)} {rPad(site, 24)} n: {rPad(stat.Count, 7)} '
+            f'wait avg/p95/max: {stat.WaitSum // stat.Count // 1000}/{stat.Percentile(stat.WaitHist, 0.95)}/{stat.WaitMax // 1000} us  '
+            f'hold avg/p95/max: {stat.HoldSum // stat.Count // 1000}/{stat.Percentile(stat.HoldHist, 0.95)}/{stat.HoldMax // 1000} us')
   print('')
 
 def ShowDiskInfo():
-  for disk in DevList:
-    print(f'Disk: {disk[0]} {disk[1]} {disk[2]} {disk[3]} {disk[4]}')
-    for part in disk[6]:
-      print(f'  - Part: {part[0]} {part[1]} {part[2]} {part[3]} {part[4]} {part[5]}')
-      print(f'          {part[6]}')
+  for disk in DevReg:
+    print(f'Disk: {disk.Name} {disk.Node} {disk.Serial} {disk.Size} {disk.Rot}')
+    for part in disk.Parts:
+      print(f'  - Part: {part.Name} {part.Node} {part.Label} {part.UUID} {part.FSType} {part.Size}')
+      print(f'          {part.Mount}')
   print('')
 
 def ShowAllThreads():
@@ -1532,24 +3079,18 @@ def NasSysDir(path):
 
 def CheckMount(mpoint):
   try:
-    nas_stat = os.stat(NasRoot)
-    if not os.path.exists(mpoint): return ''
-    mpt_stat = os.stat(mpoint)
-    if nas_stat.st_dev == mpt_stat.st_dev: return ''
+    if not Mounts.Mounted(mpoint): return ''
     else: return f'Warning: it seems that {mpoint} is still mounted.'
   except Exception as E:
     return f'CheckMount Error: {E}'
 
 def RemoveUnmounted():
   try:
-    MountPoints = [os.path.join(NasRoot, folder) for folder in os.listdir(NasRoot) if os.path.isdir(os.path.join(NasRoot, folder))]
-    nas_stat = os.stat(NasRoot)
-    for I in range(len(MountPoints)-1, -1, -1):
-      mpt_stat = os.stat(MountPoints[I])
-      if nas_stat.st_dev == mpt_stat.st_dev:
-        try: os.rmdir(MountPoints[I])
-        except: pass
-      else: del MountPoints[I]
+    MountPoints = [os.path.join(NasRoot, folder) for folder in os.listdir(NasRoot)]
+    MountPoints = [mpoint for mpoint in MountPoints if not Mounts.Mounted(mpoint) and os.path.isdir(mpoint)]
+    for mpoint in MountPoints:
+      try: os.rmdir(mpoint)
+      except: pass
     ChangeFileLines('/etc/fstab', [], MountPoints)
   except: pass
 
@@ -1631,6 +3172,7 @@ def SendBackOnline():
     with i2cLock: SBuff = I2CBus.read_i2c_block_data(PicoAddr, regAlert, 16)
     SRegShd = bytes(SBuff[:4]);   REG_Shutdown = SRegShd
     SRegPwr = bytes(SBuff[4:8]);  REG_Power = SRegPwr
+    SpinUp.SetPower(SRegPwr == stPowerOFF)
     SRegBat = bytes(SBuff[8:12]); REG_Battery = SRegBat
     SRegOvr = bytes(SBuff[12:]);  REG_BatOver = SRegOvr
     StatType = 1 if (SRegPwr == stPowerON) and (SRegBat == stBatON) and (SRegShd != stShdLow) else 2
@@ -1834,6 +3376,8 @@ def GetNotifParams(MsgCode):
       if MsgCode == BatAvailMsg:  return Notif.getboolean('BatAvail.comp'),  Notif.getboolean('BatAvail.push'),  Notif.getboolean('BatAvail.log'),  UseIdle, IdleVal
       if MsgCode == BatOvr1Msg:   return Notif.getboolean('BatOvr1.comp'),   Notif.getboolean('BatOvr1.push'),   Notif.getboolean('BatOvr1.log'),   UseIdle, IdleVal
       if MsgCode == BatOvr0Msg:   return Notif.getboolean('BatOvr0.comp'),   Notif.getboolean('BatOvr0.push'),   Notif.getboolean('BatOvr0.log'),   UseIdle, IdleVal
+      if MsgCode == SlowDisk1Msg: return Notif.getboolean('SlowDisk.comp'),  Notif.getboolean('SlowDisk.push'),  Notif.getboolean('SlowDisk.log'),  UseIdle, IdleVal
+      if MsgCode == SlowDisk0Msg: return Notif.getboolean('SlowDisk.comp'),  Notif.getboolean('SlowDisk.push'),  Notif.getboolean('SlowDisk.log'),  UseIdle, IdleVal
       if MsgCode == AppTermMsg:   return Notif.getboolean('AppTerm.comp'),   Notif.getboolean('AppTerm.push'),   Notif.getboolean('AppTerm.log'),   UseIdle, IdleVal
       if MsgCode == HddPark1Msg:  return Notif.getboolean('HddPark.comp'),   Notif.getboolean('HddPark.push'),   Notif.getboolean('HddPark.log'),   UseIdle, IdleVal
       if MsgCode == HddPark0Msg:  return Notif.getboolean('HddPark.comp'),   Notif.getboolean('HddPark.push'),   Notif.getboolean('HddPark.log'),   UseIdle, IdleVal
@@ -1882,7 +3426,7 @@ def SendMessageToAndro(Msg, LID):
       'msg_body' : Msg,
       'msg_level': MsgLevel[LID],
       'msg_time' : TimeEnc }
-    Response = requests.post(FCMLink, headers=Headers, json=Payload)
+    Response = requests.post(FCMLink, headers=Headers, json=Payload, timeout=PushTimeout)
     return (Response.status_code == 200)
   except Exception as E:
     if Debug: print(f' SendMessageToAndro error: {E}')
@@ -1949,7 +3493,7 @@ def SetNetworkCfg(CIP, CPort, RIP, RPort):
 
      #--- Standby -------
 
-def PackStandbyCfg():
+def PackStandbyCfg(Learned=False):  # Learned: the adaptive block is appended (CMD_STBLEARN), the app never sends it back
   def GetDiskParams(Data):
     Vals = Data.split('/')
     return int(Vals[0]), int(Vals[1])
@@ -1965,6 +3509,9 @@ def PackStandbyCfg():
       for Serial in StbCustom:
         ValKA, ValSB = GetDiskParams(StbCustom[Serial])
         StbPack += PackSStr(Serial) + struct.pack('<II', ValKA, ValSB)
+      if Learned:
+        Adaptive = Config['StandbyAdaptive']
+        StbPack += struct.pack('<?', Adaptive.getboolean('Enabled')) + StbLearn.Pack(Adaptive, max(ChkPer, 1))
     return StbPack
   except Exception as E:
     if Debug: print(RED+f' PackStandbyCfg error: {E}'+RESET)
@@ -1972,6 +3519,7 @@ def PackStandbyCfg():
 
 def SetStbConfig(Buff):
   try:
+    Changed = False
     with cfgLock:
       if PackStandbyCfg() != Buff:
         Standby = Config['Standby']; I = 0
@@ -1986,30 +3534,26 @@ def SetStbConfig(Buff):
           Serial, Size = UnpackSStr(Buff, I); I += Size
           DiskKA, DiskSB = struct.unpack('<II', Buff[I:I+8]); I += 8
           StbCustom[Serial] = str(DiskKA) + '/' + str(DiskSB)
-        SaveConfig()
-        with devLock:
-          SetCheckPeriod(ChkPer)
-          UpdateBlockDevices()
-          if Debug: ShowStatInfo()
-        if Debug: print(' Standby settings updated')
+        SaveConfig(); Changed = True
       else:
         if Debug: print(' Received the same Standby settings')
+    if Changed:  # disks are probed outside of the config lock
+      with devLock: SetCheckPeriod(ChkPer)
+      UpdateBlockDevices()
+      with devLock:
+        if Debug: ShowStatInfo()
+      if Debug: print(' Standby settings updated')
     return True
   except Exception as E:
     if Debug: print(RED+f' SetStbConfig error: {E}'+RESET)
     return False
 
-def SetCheckPeriod(Value):
+def SetCheckPeriod(Value):  # the stamps are in seconds, only the deadlines are moved
   global CheckPeriod
-  with clkLock:
-    with devLock:
-      for dev in DevList:
-        AliveTime = dev[5][1] * CheckPeriod
-        dev[5][1] = AliveTime // Value
-        IdleTime  = dev[5][2] * CheckPeriod
-        dev[5][2] = IdleTime // Value
-      CheckPeriod = Value
-      if Debug: print(f'\nCheck Period = {CheckPeriod} seconds\n')
+  with devLock:
+    CheckPeriod = Value
+    for disk in DevReg: DiskSched.Schedule(disk)
+    if Debug: print(f'\nCheck Period = {CheckPeriod} seconds\n')
 
      #--- A.P.M. ---------
 
@@ -2033,6 +3577,7 @@ def PackApmCfg():
 
 def SetApmConfig(Buff):
   try:
+    Changed = False
     with cfgLock:
       if PackApmCfg() != Buff:
         Apm = Config['APM']; I = 0
@@ -2047,13 +3592,13 @@ def SetApmConfig(Buff):
           Serial, Size = UnpackSStr(Buff, I); I += Size
           DiskApm = struct.unpack('<B', Buff[I:I+1])[0]; I += 1
           ApmCustom[Serial] = str(DiskApm)
-        SaveConfig()
-        with devLock:
-          for disk in DevList:
-            if disk[5][3] == 1: SetTargetAPM(disk)
-        if Debug: print(' APM settings updated')
+        SaveConfig(); Changed = True
       else:
         if Debug: print(' Received the same APM settings')
+    if Changed:  # all active disks at once, outside of the config lock
+      with devLock: Disks = [disk for disk in DevReg if disk.Stat.State == 1]
+      AtaForAll(Disks, SetTargetAPM)
+      if Debug: print(' APM settings updated')
     return True
   except Exception as E:
     if Debug: print(RED+f' SetApmConfig error: {E}'+RESET)
@@ -2245,83 +3790,162 @@ def SetSilentConfig(Buff):
 
 # ----- Devices section ----------------------------
 
-def UpdateBlockDevices():
+def ProbeDisk(dev, cls, Prev):  # no lock needed / Prev: (KAS, SBT) of the registered disk, None for a new one
+  props = Props.Get(dev)
+  dev_serial = props.Serial
+  dev_size = props.Size
+  dev_rot = props.Rot
+  dev_parts = GetPartition(dev)
+  apm_avail = ApmAvailable(dev_serial, False)
+  KAS, SBT = GetDevStandbyParams(dev_serial)
+  IsKnown = (KAS > 0) or (SBT > 0)
+  if Prev != None:  # already exists: wake it if it just became known
+    WasKnown = (Prev[0] > 0) or (Prev[1] > 0)
+    Woken = cls.Standby and IsKnown and not WasKnown
+  else:             # new drive
+    Woken = cls.Standby and (dev_rot == 2) and IsKnown and not StartInStandby
+  if Woken:                                   # on battery the read may time out in the spin-up queue: the disk stays asleep
+    Woken = KeepAlive(dev.device_node) > 0
+    if Debug and not Woken: print(f' ProbeDisk: {dev.device_node} did not spin up in time')
+  if Woken and (apm_avail == 0): apm_avail = ApmAvailable(dev_serial, True, dev.device_node)
+  disk = DiskRec(dev.sys_name, dev.device_node, dev_serial, dev_size, dev_rot, cls, DiskStatus(KAS=KAS, SBT=SBT), dev_parts, apm_avail)
+  if Woken: SetTargetAPM(disk)
+  return disk, Woken
+
+def ProbeDisks(Devs):  # do not call it under devLock / Devs: list of (pyudev device, DiskClass)
+  def _Probe(item):  # return: list of (DiskRec, Woken), None for failed probes
+    dev, cls = item
+    try: return ProbeDisk(dev, cls, Prev[dev.device_node])
+    except Exception as E:
+      if Debug: print(RED+f' ProbeDisk error [{dev.device_node}]: {E}'+RESET)
+      return None
+  with devLock:
+    Prev = {}
+    for dev, cls in Devs:
+      disk = DevReg.Disk(dev.device_node)
+      Prev[dev.device_node] = None if disk == None else (disk.Stat.KAS, disk.Stat.SBT)
+  if len(Devs) < 2: return [_Probe(item) for item in Devs]
+  with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(Devs), ProbeWorkers), thread_name_prefix='Disk Probe') as Pool:
+    return list(Pool.map(_Probe, Devs))
+
+def ForgetDisk(dev_node):  # call it under devLock: the disk left the system
+  disk = DevReg.Remove(dev_node)
+  KASrv.Drop(dev_node); AtaFallback.discard(dev_node); Latency.Drop(dev_node)
+  if (disk != None) and (disk.Serial != ''): Wear.Drop(disk.Serial)
+
+def CommitDisk(new, Woken):  # call it under devLock
+  NStat = new.Stat
+  IsKnown = (NStat.KAS > 0) or (NStat.SBT > 0)
+  disk = DevReg.Disk(new.Node)
+  if disk != None:  # already exists
+    DStat = disk.Stat
+    WasKnown = (DStat.KAS > 0) or (DStat.SBT > 0)
+    DStat.KAS = NStat.KAS; DStat.SBT = NStat.SBT
+    if WasKnown and not IsKnown:
+      DStat.State = 0; DStat.StateName = 'unknown'
+    if not WasKnown and IsKnown:
+      if Woken or not disk.Managed():
+        DStat.State = 1; DStat.StateName = 'active'
+        DStat.Touch()
+      else:                                                 # the wake read timed out: no KA deadline for a sleeping disk
+        DStat.State = 2; DStat.StateName = 'standby'
+        DStat.KAStamp = time.monotonic()
+      SyncCounters(disk)                                    # counters baseline, our KeepAlive excluded
+    disk.Name = new.Name; disk.Serial = new.Serial; disk.Size = new.Size
+    disk.Rot = new.Rot; disk.Parts = new.Parts; disk.ApmAvail = new.ApmAvail
+  else:             # new drive
+    disk = new
+    if disk.Managed() and IsKnown:
+      if Woken: NStat.State = 1; NStat.StateName = 'active'
+      else: NStat.State = 2; NStat.StateName = 'standby'
+    SyncCounters(disk)                                      # counters baseline, our KeepAlive excluded
+  DevReg.Put(disk)
+  DiskSched.Schedule(disk)
+  return disk
+
+def UpdateBlockDevices():  # do not call it under devLock: disks are probed in parallel, then committed at once
   global StartInStandby
-  UpdateMountPoints(); UpdateCounters(); NewDisks = []
-  for dev in UDEV.list_devices(subsystem='block', DEVTYPE='disk'):
-    if re.match(r'sd[a-z]$', dev.sys_name):
-      NewDisks.append(dev.sys_name)
-      Idx = GetDiskIndex(dev.device_node)
-      if not ('ID_SERIAL_SHORT' in dev.properties): dev_serial = ''
-      else: dev_serial = dev.properties['ID_SERIAL_SHORT']
-      dev_size = GetFileSize(dev.device_node)
-      dev_rot = RotationalDisk(dev.sys_name)
-      dev_parts = GetPartition(dev)
-      apm_avail = ApmAvailable(dev_serial, False)  
-      KAS, SBT = GetDevStandbyParams(dev_serial)
-      IsKnown = (KAS > 0) or (SBT > 0); do_apm = False  
-      if Idx != None:  # already exists
-        dev_stat = DevList[Idx][5]
-        WasKnown = (dev_stat[5] > 0) or (dev_stat[6] > 0)
-        dev_stat[5] = KAS; dev_stat[6] = SBT
-        if WasKnown and not IsKnown:
-          dev_stat[3] = 0; dev_stat[4] = 'unknown'
-        if not WasKnown and IsKnown:
-          do_apm = True  
-          dev_stat[3] = 1; dev_stat[4] = 'active'
-          dev_stat[0] = GetDiskCount(dev.sys_name) + KeepAliveAsync(dev.device_node)
-          dev_stat[1] = 0; dev_stat[2] = 0
-          if apm_avail == 0: apm_avail = ApmAvailable(dev_serial)
-        DevList[Idx] = [dev.sys_name, dev.device_node, dev_serial, dev_size, dev_rot, dev_stat, dev_parts, apm_avail]
-        if do_apm: SetTargetAPM(DevList[Idx])
-      else:            # new drive
-        if dev_rot != 2:
-          dev_stat = [0, 0, 0, 0, 'unknown']
-        else:
-          new_count = GetDiskCount(dev.sys_name)
-          if not IsKnown:
-            ST_Code = 0; ST_Name = 'unknown'
-          else:
-            if StartInStandby:
-              ST_Code = 2; ST_Name = 'standby'
-            else:
-              do_apm = True  
-              ST_Code = 1; ST_Name = 'active'
-              new_count += KeepAlive(dev.device_node)
-              if apm_avail == 0: apm_avail = ApmAvailable(dev_serial)
-          dev_stat = [new_count, 0, 0, ST_Code, ST_Name, KAS, SBT]
-        DevList.append([dev.sys_name, dev.device_node, dev_serial, dev_size, dev_rot, dev_stat, dev_parts, apm_avail])
-        if do_apm: SetTargetAPM(DevList[-1])
-  for old_disk in DevList:
-    for new_disk in NewDisks:
-      if old_disk[0] == new_disk: break
-    else: DevList.remove(old_disk)
-  if len(DevList) > 0: DevList.sort(key=lambda x: x[0])
+  Devs = []
+  for name, cls in ListDisks():
+    try: Devs.append((pyudev.Devices.from_name(UDEV, 'block', name), cls))
+    except pyudev.DeviceNotFoundError: pass
+  Probes = ProbeDisks(Devs)
+  with devLock:
+    NewDisks = set(dev.device_node for dev, cls in Devs)
+    for probe in Probes:
+      if probe != None: CommitDisk(*probe)
+    for old_node in DevReg.Nodes() - NewDisks: ForgetDisk(old_node)
+    RefreshGroups()
   StartInStandby = False
 
-def PackBlockDevices():
-  buff = struct.pack('<H', len(DevList))
-  for disk in DevList:
-    buff += PackWStr(disk[0]) + PackWStr(disk[1]) + PackWStr(disk[2])
-    buff += struct.pack('<QBBQIIB', disk[3], disk[4], disk[7], disk[5][0], disk[5][1], disk[5][2], disk[5][3])
-    buff += PackWStr(disk[5][4]) + struct.pack('<H', len(disk[6]))
-    for part in disk[6]:
-      for i in range(5): buff += PackWStr(part[i])
-      buff += struct.pack('<QH', part[5], len(part[6]))
-      for mp in part[6]: buff += PackWStr(mp)
-  return buff
-
-def DevNode(Serial): 
-  with devLock:
-    for dev in DevList:
-      if dev[2] == Serial: return dev[1]
-    else: return ''
-    
-def DevSerial(dev_node): 
+def ApplyDevEvents(Events):  # do not call it under devLock / return: True if the device table was changed
+  Disks = {}; Parts = {}
+  for name, (action, devtype, dev_node, parent) in Events.items():
+    Props.Invalidate(name)
+    if devtype == 'disk':
+      cls = ClassifyDisk(name)
+      if cls != None: Disks[name] = (action, dev_node, cls)
+    elif (ClassifyDisk(parent) != None) and not (parent in Events):
+      Parts[name] = (action, dev_node, parent)
+  if len(Disks) + len(Parts) == 0: return False
+  Removed = []; Devs = []
+  for name, (action, dev_node, cls) in Disks.items():   # added or changed disks are probed entirely
+    if Debug: print(f'Disk {action}: {dev_node}')
+    if action == 'remove': Removed.append(dev_node); continue
+    try: Devs.append((pyudev.Devices.from_name(UDEV, 'block', name), cls))
+    except pyudev.DeviceNotFoundError: Removed.append(dev_node)
+  Probes = ProbeDisks(Devs)
+  NewParts = {}
+  for name, (action, part_node, parent) in Parts.items():   # only the affected partition is probed
+    if Debug: print(f'Partition {action}: {part_node}')
+    NewParts[name] = None
+    if action != 'remove':
+      try: NewParts[name] = ProbePart(pyudev.Devices.from_name(UDEV, 'block', name))
+      except pyudev.DeviceNotFoundError: pass
   with devLock:
-    for dev in DevList:
-      if dev[1] == dev_node: return dev[2]
-    else: return ''
+    for dev_node in Removed: ForgetDisk(dev_node)
+    for probe in Probes:
+      if probe != None: CommitDisk(*probe)
+    for name, (action, part_node, parent) in Parts.items():
+      disk = DevReg.Disk('/dev/'+parent)
+      if disk == None: continue
+      new_part = NewParts[name]
+      parts = [part for part in disk.Parts if part.Node != part_node]
+      if new_part != None:
+        for I in range(len(disk.Parts)):
+          if disk.Parts[I].Node == part_node:
+            parts.insert(I, new_part); break
+        else: parts.append(new_part)
+      disk.Parts = parts
+      DevReg.Put(disk)
+    RefreshGroups()
+  return True
+
+def PackBlockDevices():  # no lock needed, the last published snapshot
+  return DevReg.Snap.Packed
+
+def PushDevices(Full=False):
+  if not devLock.acquire(blocking=False):   # busy with a slow drive: do not wait, send the last snapshot
+    DevReg.SentStruct = -1                  # the next push sends the whole tree again
+    return SendBuff(CMD_DEVICES, PackBlockDevices())
+  try:
+    if Full or not DevDeltaEn or (DevReg.SentStruct != DevReg.StructVer):
+      Cmd = CMD_DEVICES; buff = DevReg.Pack()
+      DevReg.MarkSent()
+    else:
+      Cmd = CMD_DEVSTAT; buff = DevReg.PackDelta()
+      if buff == None: return True
+  finally: devLock.release()
+  Done = SendBuff(Cmd, buff)
+  if not Done:
+    with devLock: DevReg.MarkSent(False)    # resend the whole tree next time
+  return Done
+
+def DevNode(Serial):
+  return DevReg.Snap.Nodes.get(Serial, '')
+
+def DevSerial(dev_node):
+  return DevReg.Snap.Serials.get(dev_node, '')
 
 def GetDevStandbyParams(Serial):
   KAS = 0; SBT = 0;
@@ -2336,51 +3960,62 @@ def GetDevStandbyParams(Serial):
             break
         else: Data = Standby['Default'].split('/')
         KAS = int(Data[0]); SBT = int(Data[1])
+        Adaptive = Config['StandbyAdaptive']
+        if (SBT > 0) and Adaptive.getboolean('Enabled'):   # a learned timeout replaces the fixed one once it is trusted
+          Res = StbLearn.Learn(Serial, Adaptive, max(Standby.getint('CheckPeriod'), 1))
+          if (Res != None) and Res[2]: SBT = Res[0]
   except: pass
   return KAS, SBT
 
-def GetFileSize(filename):
-  fd = os.open(filename, os.O_RDONLY)
+def SysfsSize(name):  # disk or partition size without opening the device node
   try:
-    size = os.lseek(fd, 0, os.SEEK_END)
+    with open(f'/sys/class/block/{name}/size', 'r') as f: return int(f.read()) * 512
   except:
-    size = 0
-    if Debug: print(f' GetFileSize error: Cannot get size of "{filename}".')
-  os.close(fd)
-  return size
+    if Debug: print(f' SysfsSize error: Cannot get size of "{name}".')
+    return 0
 
 def UpdateCounters():
-  global Counters
-  Counters = psutil.disk_io_counters(perdisk=True)
+  try: DStats.Refresh()
+  except Exception as E:
+    if Debug: print(f' UpdateCounters error: {E}')
 
 def GetDiskCount(disk_name):  # update counters first
-  for disk in Counters:
-    if disk == disk_name:
-      return Counters[disk].read_count + Counters[disk].write_count
-  else: return 0
-
-def UpdateMountPoints():
-  global MountPoints
-  MountPoints = psutil.disk_partitions()
-
-def GetMountPoint(dev_node):  # update mount points first
-  for mp in MountPoints:
-    if mp.device == dev_node:
-      if mp.mountpoint == '/': mnt_dir = mp.mountpoint
-      else: mnt_dir = mp.mountpoint.rsplit('/',1)[-1]
-      return [mnt_dir, mp.mountpoint, mp.fstype, mp.opts]
-  else: return []
-
-def GetPartition(disk_dev):   # update mount points first
-  parts = []
-  for part in disk_dev.children:
-    part_lab  = part.get('ID_FS_LABEL'); part_lab  = '' if part_lab is None else part_lab
-    part_uuid = part.get('ID_FS_UUID');  part_uuid = '' if part_uuid is None else part_uuid
-    part_fst  = part.get('ID_FS_TYPE');  part_fst  = '' if part_fst is None else part_fst
-    part_size = GetFileSize(part.device_node)
-    part_mount = GetMountPoint(part.device_node)
-    parts.append((part.sys_name, part.device_node, part_lab, part_uuid, part_fst, part_size, part_mount))
-  return parts
+  return DStats.Ops(disk_name)
+
+def SyncCounters(disk):       # re-read the counters of a single disk, after our own I/O
+  DStats.RefreshDisk(disk.Name)
+  disk.Stat.IOCount = DStats.Ops(disk.Name)
+  disk.Stat.IOTicks = DStats.Get(disk.Name, dsIOTicks)
+
+def DiskActivity(disk):       # update counters first / return: IO count delta, True if the disk was busy
+  DStat = disk.Stat
+  new_count = DStats.Ops(disk.Name)
+  new_ticks = DStats.Get(disk.Name, dsIOTicks)
+  delta = new_count - DStat.IOCount
+  busy = (delta > 0) or (new_ticks != DStat.IOTicks) or (DStats.Get(disk.Name, dsInFlight) > 0)
+  DStat.IOCount = new_count; DStat.IOTicks = new_ticks
+  return delta, busy
+
+def GetMountPoint(dev_node):
+  return Mounts.Node(dev_node)
+
+def UpdatePartMounts():  # call it under devLock / return: True if any mount point was changed
+  Changed = False
+  for disk in DevReg:
+    Dirty = False
+    for part in disk.Parts:
+      mount = GetMountPoint(part.Node)
+      if mount != part.Mount: part.Mount = mount; Dirty = True
+    if Dirty: DevReg.Put(disk); Changed = True
+  return Changed
+
+def GetPartition(disk_dev):
+  return [ProbePart(part) for part in disk_dev.children]
+
+def ProbePart(part):
+  props = Props.Get(part, os.path.basename(os.path.dirname(part.sys_path)))
+  part_mount = GetMountPoint(part.device_node)
+  return PartRec(part.sys_name, part.device_node, props.Label, props.UUID, props.FSType, props.Size, part_mount)
 
 def RotationalDisk(disk_name):
   rot_file = '/sys/block/{}/queue/rotational'.format(disk_name)
@@ -2389,96 +4024,173 @@ def RotationalDisk(disk_name):
      return int(f.read().strip()) + 1
   except: return 0
 
-def GetDiskIndex(dev_node):
-  for D in range(len(DevList)):
-    if DevList[D][1] == dev_node: return D
-  else: return None
-
-def GetPartIndex(part_node):
-  for D in range(len(DevList)):
-    for P in range(len(DevList[D][6])):
-      if DevList[D][6][P][1] == part_node: return D, P
-  else: return None, None
-
-def PartMountInfo(part_node):
+def PartMountInfo(part_node):  # call it under devLock
   uuid = None; fstype = None; mpoint = None
-  D, P = GetPartIndex(part_node)
-  if P != None:
-    uuid   = DevList[D][6][P][3]
-    fstype = DevList[D][6][P][4]
-    mpoint = DevList[D][6][P][6]
+  disk, part = DevReg.Part(part_node)
+  if part != None:
+    uuid   = part.UUID
+    fstype = part.FSType
+    mpoint = part.Mount
   return uuid, fstype, mpoint
 
 
-def SwitchToActive(dev_node):
-  try:  
+def HolderName(name):  # md arrays by their kernel name, device mapper (LVM, crypt) by its table name
+  try:
+    with open(f'/sys/class/block/{name}/dm/name', 'r') as f: return f.read().strip()
+  except: return name
+
+def GroupKeys(disk):  # every md / dm device stacked on the disk or its partitions, plus its btrfs filesystems
+  Keys = set(); Todo = [disk.Name] + [part.Name for part in disk.Parts]
+  while len(Todo) > 0:
+    name = Todo.pop()
+    try: holders = os.listdir(f'/sys/class/block/{name}/holders')
+    except: continue
+    for holder in holders:
+      if holder not in Keys: Keys.add(holder); Todo.append(holder)
+  Keys = set(HolderName(key) for key in Keys)
+  for part in disk.Parts:
+    if (part.FSType == 'btrfs') and (part.UUID != ''): Keys.add('btrfs:' + part.UUID)
+  return Keys
+
+def RefreshGroups():  # call it under devLock / disks sharing a key are joined in one group
+  Owner = {}; Parent = {}
+  def Root(node):
+    while Parent[node] != node: node = Parent[node]
+    return node
+  Keys = {}
+  for disk in DevReg:
+    Parent[disk.Node] = disk.Node; Keys[disk.Node] = GroupKeys(disk)
+    for key in Keys[disk.Node]:
+      other = Owner.setdefault(key, disk.Node)
+      if other != disk.Node: Parent[Root(disk.Node)] = Root(other)
+  Members = {}
+  for node in Parent: Members.setdefault(Root(node), []).append(node)
+  Map = {}
+  for nodes in Members.values():
+    if len(nodes) < 2: continue
+    Shared = set.intersection(*[Keys[node] for node in nodes]) or set.union(*[Keys[node] for node in nodes])
+    for node in nodes: Map[node] = sorted(Shared)[0]
+  DevReg.SetGroups(Map)
+
+def SyncGroups(Before, Busy, now, Actions):  # call it under devLock, standby goes to Actions / return: members to wake, True if states were changed
+  Wake = []; Changed = False
+  for members in DevReg.Groups.values():
+    members = [disk for disk in members if disk.Managed() and ((disk.Stat.KAS > 0) or (disk.Stat.SBT > 0))]
+    if len(members) < 2: continue
+    if any(disk.Node in Busy for disk in members):               # one idle timer for the whole group
+      for disk in members:
+        if (disk.Stat.State == 1) and not (disk.Node in Busy):
+          disk.Stat.IdleStamp = now; DiskSched.Schedule(disk)
+    if any(((Before.get(disk.Node) == 2) and (disk.Stat.State == 1)) or disk.Stat.Waking for disk in members):  # one woke up: wake the rest
+      Wake += [disk.Node for disk in members if (disk.Stat.State == 2) and not disk.Stat.Waking]
+    elif any((Before.get(disk.Node) == 1) and (disk.Stat.State == 2) for disk in members):  # one went to sleep: all sleep
+      for disk in members:                                       # only the ones with a standby timeout, idle this round
+        DStat = disk.Stat
+        if (DStat.State != 1) or (DStat.SBT == 0) or DStat.Waking or (disk.Node in Busy): continue
+        Actions.append((disk, 'standby'))
+        DStat.KAStamp = now; DStat.State = 2; DStat.StateName = 'standby'
+        DiskSched.Schedule(disk); Changed = True
+  return Wake, Changed
+
+def NotifySpinQueue(dev_node, pos):
+  SendMessageToComp(CMD_MESSAGE, f'{dev_node} is waiting to spin up, position {pos} in the queue.', 1)
+
+def ClaimWake(dev_node):  # call it under devLock / return: True if the caller now owns the wake of the disk
+  disk = DevReg.Disk(dev_node)
+  if (disk == None) or not disk.Managed() or disk.Stat.Waking: return False
+  disk.Stat.Waking = True                                   # DevicesTask ignores the wake read
+  return True
+
+def SwitchToActive(dev_node, Notify=NotifySpinQueue, Claimed=False):  # the drive is accessed outside devLock / Claimed: ClaimWake was done
+  try:
     with devLock:
-      Idx = GetDiskIndex(dev_node)
-      if (Idx == None) or (DevList[Idx][4] != 2): return    # exit if no device or no HDD
-      KeepAlive(dev_node)                                   # access the drive to wake
-      if DevList[Idx][7] == 0:
-        DevList[Idx][7] = ApmAvailable(DevList[Idx][2])     # update APM Avail
-      SetTargetAPM(DevList[Idx])                            # update APM  
-      UpdateCounters()  
-      DStat = DevList[Idx][5]
-      DStat[0] = GetDiskCount(DevList[Idx][0])              # update IO count      
-      DStat[1] = 0; DStat[2] = 0                            # reset KA and Idle counters
-      DStat[3] = 1; DStat[4] = 'active'                     # mark it as active
-      SendBuff(CMD_DEVICES, PackBlockDevices())             # send new status
+      disk = DevReg.Disk(dev_node)
+      if disk == None: return                               # exit if no device
+      if not (Claimed or ClaimWake(dev_node)): return       # exit if no HDD or another thread is already waking it
+      DStat = disk.Stat
+    try:
+      if KeepAlive(dev_node, Notify) == 0:                  # access the drive to wake, queued behind other spin-ups
+        if Debug: print(f' SwitchToActive: {dev_node} did not spin up in time')
+        return                                              # still asleep: no SET FEATURES outside the spin-up queue
+      if disk.ApmAvail == 0:
+        disk.ApmAvail = ApmAvailable(disk.Serial)           # update APM Avail
+      SetTargetAPM(disk)                                    # update APM
+      with devLock:
+        SyncCounters(disk)                                  # update IO count
+        DStat.Touch()                                       # reset KA and Idle counters
+        DStat.State = 1; DStat.StateName = 'active'         # mark it as active
+        DiskSched.Schedule(disk)                            # new KA and standby deadlines
+    finally:
+      with devLock: DStat.Waking = False
+    PushDevices()                                           # send new status
   except Exception as E:
     if Debug: print(RED+f'SwitchToActive error: {E}'+RESET)
 
-def SwitchToStandby(dev_node):
-  try:  
+def SwitchToStandby(dev_node):  # the drive is accessed outside devLock
+  try:
     with devLock:
-      Idx = GetDiskIndex(dev_node)
-      if (Idx == None) or (DevList[Idx][4] != 2): return    # exit if no device or no HDD
-      PutInStandby(dev_node)                                # put the drive in standby
-      UpdateCounters()  
-      DStat = DevList[Idx][5]
-      DStat[0] = GetDiskCount(DevList[Idx][0])              # update IO count      
-      DStat[1] = 0                                          # reset KA
-      DStat[3] = 2; DStat[4] = 'standby'                    # mark it as inactive
-      SendBuff(CMD_DEVICES, PackBlockDevices())             # send new status
+      disk = DevReg.Disk(dev_node)
+      if (disk == None) or not disk.Managed(): return       # exit if no device or no HDD
+    PutInStandby(dev_node)                                  # put the drive in standby
+    with devLock:
+      SyncCounters(disk)                                    # update IO count
+      DStat = disk.Stat
+      DStat.KAStamp = time.monotonic()                      # reset KA
+      DStat.State = 2; DStat.StateName = 'standby'          # mark it as inactive
+      DiskSched.Schedule(disk)                              # drop its deadlines
+    PushDevices()                                           # send new status
   except Exception as E:
     if Debug: print(RED+f'SwitchToStandby error: {E}'+RESET)
 
 def UpdatePowerStatus(dev_node, send=True):
   try:
-    time.sleep(0.2)  
+    time.sleep(0.2)
     isAct = IsDriveActive(dev_node)
     if isAct == None: return False
     with devLock:
-      Idx = GetDiskIndex(dev_node)
-      if (Idx == None) or (DevList[Idx][4] != 2): return False  # exit if no device or no HDD
-      DStat = DevList[Idx][5];
-      if DStat[3] == 0: return False                            # exit if status unknown
-      wasAct = DStat[3] != 2;
-      if wasAct == isAct: return False                          # exit if status unchanged 
-      UpdateCounters()  
-      DStat[0] = GetDiskCount(DevList[Idx][0])              # update IO count      
+      disk = DevReg.Disk(dev_node)
+      if (disk == None) or not disk.Managed(): return False # exit if no device or no HDD
+      DStat = disk.Stat
+      if DStat.State == 0: return False                     # exit if status unknown
+      wasAct = DStat.State != 2
+      if wasAct == isAct: return False                      # exit if status unchanged
+      SyncCounters(disk)                                    # update IO count
       if isAct: # drive has become active
-        DStat[1] = 0; DStat[2] = 0                          # reset KA and Idle counters
-        DStat[3] = 1; DStat[4] = 'active'                   # mark it as active
-        if DevList[Idx][7] == 0:
-          DevList[Idx][7] = ApmAvailable(DevList[Idx][2])   # update APM Avail
-        SetTargetAPM(DevList[Idx])                          # update APM  
+        DStat.Touch()                                       # reset KA and Idle counters
+        DStat.State = 1; DStat.StateName = 'active'         # mark it as active
       else:     # drive has become inactive
-        DStat[1] = 0                                        # reset KA
-        DStat[3] = 2; DStat[4] = 'standby'                  # mark it as inactive
-      if send: SendBuff(CMD_DEVICES, PackBlockDevices())    # send new status
-      return not send
+        DStat.KAStamp = time.monotonic()                    # reset KA
+        DStat.State = 2; DStat.StateName = 'standby'        # mark it as inactive
+      DiskSched.Schedule(disk)                              # new KA and standby deadlines
+    if isAct:
+      if disk.ApmAvail == 0:
+        disk.ApmAvail = ApmAvailable(disk.Serial)           # update APM Avail
+      SetTargetAPM(disk)                                    # update APM
+    if send: PushDevices()                                  # send new status
+    return not send
   except Exception as E:
     if Debug: print(RED+f'UpdatePowerStatus error: {E}'+RESET)
     return False
 
+def StandbyDisk(dev_node):  # return: '' on success, else the error message
+  Done, Err = AtaRun(dev_node, AtaStandby)
+  if Err != None: return Err
+  if Done == None:
+    try:
+      result = subprocess.run(['/usr/sbin/hdparm', '-y', dev_node], capture_output=True, text=True)
+      if result.returncode != 0: return result.stderr.strip()
+    except Exception as E: return str(E)
+  return ''
+
 def PutInStandby(dev_node):
-  try:
-    result = subprocess.run(['/usr/sbin/hdparm', '-y', dev_node], capture_output=(not Debug))
-    return result.returncode == 0
-  except: return False
+  Err = StandbyDisk(dev_node)
+  if Debug and (Err != ''): print(f' PutInStandby error: {Err}')
+  return Err == ''
 
 def IsDriveActive(dev_node):
+  Power, Err = AtaRun(dev_node, AtaCheckPower)
+  if Power != None: return Power != 0x00
+  if Debug and (Err != None): print(f' IsDriveActive: {Err}, using smartctl')
   try:
     result = subprocess.run(['/usr/sbin/smartctl', '-n', 'standby', dev_node], capture_output=True, text=True)  
     return not ('STANDBY mode' in result.stdout)
@@ -2487,59 +4199,188 @@ def IsDriveActive(dev_node):
       print('\n' + RED + 'IsDriveActive exception:' + RESET)
       traceback.print_exception(type(E), E, E.__traceback__)
 
-def KeepAlive(dev_node):
-  disk_fd = None; fm = None; fl = None; result = 0
-  try:
-    try:
-      disk_fd = os.open(dev_node, os.O_RDONLY | os.O_DIRECT)
-      disk_size = os.lseek(disk_fd, 0, os.SEEK_END)
-      read_pos = int(disk_size * 0.9) // 4096 * 4096
-      os.lseek(disk_fd, read_pos, os.SEEK_SET);
-      fl = os.fdopen(disk_fd, 'rb', 0)
-      fm = mmap.mmap(-1, 4096)
-      fl.readinto(fm)
-      result = 1
-    finally:
-      if fm != None: fm.close()
-      if fl != None:
-        fl.close()
-      else:
-        if disk_fd != None: os.close(disk_fd)
-  except Exception as E:
-    if Debug: print(f' KeepAlive error: {E}')
-  return result
+def KeepAlive(dev_node, Notify=None, Awake=False):  # Awake: the disk is known to spin, no spin-up slot is taken
+  return KASrv.KeepAlive([dev_node], Notify=Notify, Awake=Awake)
+
+
+# ----- Devices: ATA pass-through -----------------------
+
+def AtaSense(sense):  # return: sense key, ASC, ASCQ, (error, status, count) or None
+  if len(sense) < 8: return 0, 0, 0, None
+  if (sense[0] & 0x7F) >= 0x72:   # descriptor format
+    key = sense[1] & 0x0F; asc = sense[2]; ascq = sense[3]
+    I = 8; End = min(len(sense), 8 + sense[7])
+    while I + 1 < End:
+      if (sense[I] == 0x09) and (I + 13 < End):   # ATA status return descriptor
+        return key, asc, ascq, (sense[I+3], sense[I+13], sense[I+5])
+      I += sense[I+1] + 2
+    return key, asc, ascq, None
+  key = sense[2] & 0x0F               # fixed format
+  asc = sense[12] if len(sense) > 12 else 0
+  ascq = sense[13] if len(sense) > 13 else 0
+  if (asc == 0x00) and (ascq == 0x1D): return key, asc, ascq, (sense[3], sense[4], sense[6])
+  return key, asc, ascq, None
+
+def AtaPassThrough(dev_node, command, features=0, count=0, data_len=0, timeout=5000):
+  # ATA PASS-THROUGH (16), non-data or PIO data-in / return: ATA (error, status, count) or None, data
+  cdb = ctypes.create_string_buffer(16)
+  sense = ctypes.create_string_buffer(32)
+  data = ctypes.create_string_buffer(max(data_len, 1))
+  cdb[0] = 0x85
+  if data_len > 0: cdb[1] = 4 << 1; cdb[2] = 0x2E   # PIO data-in, CK_COND, from device, blocks in count
+  else: cdb[1] = 3 << 1; cdb[2] = 0x20               # non-data, CK_COND: always return the ATA registers
+  cdb[4] = features; cdb[6] = count; cdb[13] = 0x40; cdb[14] = command
+  hdr = bytearray(struct.pack(SgHdrFmt, ord('S'), SG_DXFER_FROM_DEV if data_len > 0 else SG_DXFER_NONE,
+                              16, 32, 0, data_len, ctypes.addressof(data) if data_len > 0 else 0,
+                              ctypes.addressof(cdb), ctypes.addressof(sense), timeout, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0))
+  try: fd = AtaIO.Open(dev_node)
+  except OSError as E: raise AtaError(ataNoDevice, f'{dev_node}: {E.strerror}')
+  try: AtaIO.Ioctl(fd, hdr)
+  except OSError as E:
+    Code = ataNoSupport if E.errno in (errno.ENOTTY, errno.EINVAL, errno.EOPNOTSUPP) else ataFailed
+    raise AtaError(Code, f'{dev_node}: SG_IO {E.strerror}')
+  finally: AtaIO.Close(fd)
+  fields = struct.unpack(SgHdrFmt, hdr)
+  if (fields[sgHostStatus] != 0) or (fields[sgDriverStatus] & 0x0F not in (0, 8)):
+    raise AtaError(ataFailed, f'{dev_node}: host status {fields[sgHostStatus]}, driver status {fields[sgDriverStatus]}')
+  key, asc, ascq, regs = AtaSense(sense.raw[:fields[sgSenseLen]])
+  if (regs != None) and (regs[1] & 0x01):
+    raise AtaError(ataAborted, f'{dev_node}: ATA command 0x{command:02X} aborted, error 0x{regs[0]:02X}')
+  if key == 0x05: raise AtaError(ataNoSupport, f'{dev_node}: ATA pass-through rejected (ASC 0x{asc:02X}/0x{ascq:02X})')
+  if (key not in (0x00, 0x01)) and (regs == None):
+    raise AtaError(ataFailed, f'{dev_node}: sense key 0x{key:X}, ASC 0x{asc:02X}/0x{ascq:02X}')
+  return regs, data.raw[:data_len]
+
+def AtaCheckPower(dev_node):  # return: CHECK POWER MODE count
+  regs, data = AtaPassThrough(dev_node, ataCheckPower)
+  if regs == None: raise AtaError(ataNoSupport, f'{dev_node}: the bridge returned no ATA registers')
+  return regs[2]
+
+def AtaStandby(dev_node):
+  AtaPassThrough(dev_node, ataStandbyNow, timeout=30000)
+  return True
 
-def KeepAliveAsync(dev_node):
-  threading.Thread(target=KeepAlive, args=(dev_node,), name='Async KeepAlive').start()
-  return 1
+def AtaSetAPM(dev_node, level):  # 1..254, 255 disables APM (like hdparm -B)
+  if level >= 255: AtaPassThrough(dev_node, ataSetFeatures, 0x85)
+  else: AtaPassThrough(dev_node, ataSetFeatures, 0x05, level)
+  return True
+
+def AtaGetAPM(dev_node):  # return: APM level, 0x100 = disabled, 0x200 = not supported (as GetAPM)
+  regs, data = AtaPassThrough(dev_node, ataIdentify, count=1, data_len=512)
+  words = array.array('H', data)
+  if sys.byteorder != 'little': words.byteswap()
+  if (words[83] & 0xC000 != 0x4000) or not (words[83] & 0x0008): return 0x200
+  if not (words[86] & 0x0008): return 0x100
+  return words[91] & 0xFF
+
+def AtaRun(dev_node, func, *args):  # return: result, error message / None, None: not supported, use the fallback
+  if dev_node in AtaFallback: return None, None
+  try: return func(dev_node, *args), None
+  except AtaError as E:
+    if E.Code != ataNoSupport: return None, str(E)
+    AtaFallback.add(dev_node)
+    if Debug: print(f' {E}, using the command line tools')
+    return None, None
+
+def AtaForAll(Items, func, *args):  # the same command for all disks at once / return: list of func results
+  if len(Items) < 2: return [func(item, *args) for item in Items]
+  with concurrent.futures.ThreadPoolExecutor(max_workers=len(Items), thread_name_prefix='ATA Command') as Pool:
+    return list(Pool.map(lambda item: func(item, *args), Items))
 
 
 # ----- Devices: SMART and APM -----------------------
 
-def GetSMART(dev_node):
-  try:
-    result = subprocess.run(['/usr/sbin/smartctl', '-A', dev_node], capture_output=True, text=True)
-    Lines = result.stdout.splitlines()
-    if result.returncode != 0:
-      Lines = [line for line in Lines if line.strip()]
-      return None, '\n'.join(Lines[2:])
-  except Exception as E:
-    return None, f'Error running smartctl: {E}'
+SmartFeatures = (('ata_aam', 'AAM feature'), ('ata_apm', 'APM feature'), ('read_lookahead', 'Read look-ahead'),
+                 ('write_cache', 'Write cache'), ('write_cache_reorder', 'Write cache reorder'),
+                 ('ata_dsn', 'DSN feature'), ('ata_security', 'ATA Security'))
+
+def ProbeSMART(dev_node, NoWake=False):  # one smartctl run for identity, attributes, health and settings
+  probe = SmartProbe()
+  cmd = ['/usr/sbin/smartctl', '--json', '-i', '-A', '-H', '--get=all', dev_node]
+  if NoWake: cmd[2:2] = ['-n', 'standby']
   try:
-    while len(Lines) > 0:
-      Stop = Lines[0].startswith('ID#')
-      del Lines[0]
-      if Stop: break
-    Attrs = []
-    for line in Lines:
-      parts = line.split()
-      if len(parts) < 10: continue
-      Name = parts[1].replace('_', ' ')
-      Name = re.sub(rf'\bCt\b', 'Count', Name)
-      Attrs.append([int(parts[0]), Name, int(parts[2], 16), int(parts[3]), int(parts[4]), int(parts[5]), int(parts[9])])
-    return Attrs, None  
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    js = json.loads(result.stdout)
   except Exception as E:
-    return None, f'Error at GetSMART: {E}'
+    probe.Error = f'Error running smartctl: {E}'; return probe
+  Msgs = [msg.get('string', '') for msg in js.get('smartctl', {}).get('messages', [])]
+  if any('STANDBY' in msg for msg in Msgs):
+    probe.Asleep = True
+    probe.Error = f'{dev_node} is in standby, there is no SMART sample yet.'; return probe
+  if js.get('smartctl', {}).get('exit_status', result.returncode) & 0x03:   # bits 0-1: command line or device open errors
+    probe.Error = '\n'.join(Msgs) if len(Msgs) > 0 else f'smartctl exit status {result.returncode}'; return probe
+  try: ParseSMART(js, probe)
+  except Exception as E: probe.Error = f'Error at ParseSMART: {E}'
+  return probe
+
+def ParseSMART(js, probe):
+  def Add(label, value):
+    if value not in (None, ''): probe.Info.append((label, str(value)))
+  Add('Model Family', js.get('model_family'))
+  Add('Device Model', js.get('model_name'))
+  Add('Serial Number', js.get('serial_number'))
+  wwn = js.get('wwn')
+  if wwn != None: Add('LU WWN Device Id', f"{wwn.get('naa', 0):x} {wwn.get('oui', 0):06x} {wwn.get('id', 0):09x}")
+  Add('Firmware Version', js.get('firmware_version'))
+  capacity = js.get('user_capacity', {}).get('bytes', js.get('nvme_total_capacity'))
+  if capacity != None: Add('User Capacity', f'{capacity:,} bytes [{capacity / 1e9:.1f} GB]')
+  if 'logical_block_size' in js:
+    Add('Sector Sizes', f"{js['logical_block_size']} bytes logical, {js.get('physical_block_size', js['logical_block_size'])} bytes physical")
+  rpm = js.get('rotation_rate')
+  if rpm != None: Add('Rotation Rate', 'Solid State Device' if rpm == 0 else f'{rpm} rpm')
+  Add('Form Factor', js.get('form_factor', {}).get('name'))
+  Add('ATA Version is', js.get('ata_version', {}).get('string'))
+  sata = js.get('sata_version', {}).get('string')
+  if sata != None:
+    speed = js.get('interface_speed', {})
+    if 'max' in speed: sata += ', ' + speed['max'].get('string', '')
+    if 'current' in speed: sata += f" (current: {speed['current'].get('string', '')})"
+    Add('SATA Version is', sata)
+  support = js.get('smart_support', {})
+  if 'available' in support:
+    Add('SMART support is', ('Enabled' if support.get('enabled') else 'Disabled') if support['available'] else 'Unavailable')
+  for key, name in SmartFeatures:
+    item = js.get(key)
+    if item != None: probe.Features.append((name, item.get('enabled', False), item.get('string', '')))
+  apm = js.get('ata_apm')
+  if apm != None: probe.APM = (apm.get('level', 0) & 0xFF) if apm.get('enabled') else 0x100
+  elif 'ata_version' in js: probe.APM = 0x200         # an ATA device without APM
+  status = js.get('smart_status')
+  if status != None: probe.Health = 'PASSED' if status.get('passed') else 'FAILED!'
+  for attr in js.get('ata_smart_attributes', {}).get('table', []):
+    Name = re.sub(r'\bCt\b', 'Count', attr.get('name', '').replace('_', ' '))
+    raw = attr.get('raw', {})                          # the leading number of the raw string, as 'smartctl -A' shows it:
+    match = re.match(r'\s*(\d+)', raw.get('string', ''))  #  the 48-bit value also packs min/max temperatures, hour fractions...
+    probe.Attrs.append([attr['id'], Name, attr.get('flags', {}).get('value', 0), attr.get('value', 0),
+                        attr.get('worst', 0), attr.get('thresh', 0), int(match.group(1)) if match else raw.get('value', 0)])
+
+def SmartInfoText(probe):  # CMD_DINFO text
+  lines = [f'{label}: {value}' for label, value in probe.Info]
+  if len(probe.Features) > 0:
+    lines.append('')
+    lines.append('Features (enabled/suported):')
+    for name, enabled, detail in probe.Features:
+      lines.append(('   [X]  ' if enabled else '   [  ]  ') + name + (f' ({detail})' if (detail != '') and enabled else ''))
+  return '\n'.join(lines) + '\n'
+
+def SendSMART(dev_node, serial):  # CMD_SMART reply from the cache, the sample age (seconds) is appended
+  rec = Smart.Get(serial)
+  if rec == None: return False
+  SPack, Err = PackSMART(rec.Attrs)
+  if SPack == None:
+    SendMessageToComp(CMD_MESSAGE, Err, 3); return False
+  SPack = struct.pack('<I', len(SPack)) + SPack
+  return SendBuff(CMD_SMART, PackSStr(serial) + PackSStr(rec.Health) + SPack + struct.pack('<I', rec.Age()), False)
+
+def SmartTTL():
+  with cfgLock: return Config['SMART'].getint('TTL', 3600)
+
+def RequestSMART(dev_node):  # served from the cache at once, a stale sample is refreshed if the disk is awake
+  serial = DevSerial(dev_node)
+  if serial == '':
+    SendMessageToComp(CMD_MESSAGE, f'{dev_node}: no serial number, SMART data is not cached.', 3); return
+  Sent = SendSMART(dev_node, serial)
+  if Smart.Due(serial, SmartTTL()): Smart.Refresh(dev_node, serial, not Sent)
 
 def PackSMART(Attrs):
   try:
@@ -2551,63 +4392,34 @@ def PackSMART(Attrs):
   except Exception as E:
     return None, f'Error at PackSMART: {E}'
 
-def GetHealth(dev_node):
-  try:
-    result = subprocess.run(['/usr/sbin/smartctl', '-H', dev_node], capture_output=True, text=True)
-    Lines = result.stdout.splitlines()
-    if result.returncode != 0:
-      Lines = [line for line in Lines if line.strip()]
-      return None, '\n'.join(Lines[2:])
-  except Exception as E:
-    return None, f'Error running smartctl: {E}'
-  try:
-    for line in Lines:
-      if 'overall-health' in line:
-        return line.split(':')[-1].strip(), None
-    return 'UNKNOWN', None
-  except Exception as E:
-    return None, f'Error at GetHealth: {E}'
-
-
 def GetAPM(dev_node):
+  APM, Err = AtaRun(dev_node, AtaGetAPM)
+  if (APM != None) or (Err != None): return APM, Err
+  probe = ProbeSMART(dev_node)
+  if probe.Error != None: return None, probe.Error
+  if probe.APM == None: return None, 'Error at GetAPM: smartctl reported no APM state'
+  return probe.APM, None
+
+def SetTargetAPM(disk):  # no lock needed, the drive is accessed and the record only read
   try:
-    result = subprocess.run(['/usr/sbin/smartctl', '--get=apm', dev_node], capture_output=True, text=True)
-    Lines = result.stdout.splitlines()
-    if result.returncode != 0:
-      Lines = [line for line in Lines if line.strip()]
-      return None, '\n'.join(Lines[2:])
-  except Exception as E:
-    return None, f'Error running smartctl: {E}'
-  try:
-    for line in Lines:
-      if 'APM' in line:
-        pattern = r'is:\s*(\w+)'
-        match = re.search(pattern, line)
-        if not match: break
-        elif match.group(1).lower().strip() == 'disabled': return 0x100, None
-        elif match.group(1).lower().strip() == 'unavailable': return 0x200, None
-        else: return int(match.group(1)), None
-    return None, 'Error at GetAPM: invalid smartctl output'
-  except Exception as E:
-    return None, f'Error at GetAPM: {E}'
-
-def SetTargetAPM(disk):  # call it under devLock
-  try:
-    if (disk[4] != 2) or (disk[7] != 2): return None  
+    if not disk.Managed() or not disk.Class.APM or (disk.ApmAvail != 2): return None
     APM = None
     with cfgLock:
       if not Config['APM'].getboolean('Enabled'): return None  
-      Serial = disk[2]
-      if Serial != '':  
+      Serial = disk.Serial
+      if Serial != '':
         ApmCustom = Config['ApmCustom']
         if Serial in ApmCustom: APM = ApmCustom.getint(Serial)
       if APM == None:
         ApmDef = Config['APM']
         if 'Default' in ApmDef: APM = ApmDef.getint('Default')
     if (APM == None) or (APM == 0): return None  
-    result = subprocess.run(['/usr/sbin/smartctl', '--set=apm,'+str(APM), disk[1]], capture_output=True, text=True)
-    if result.returncode == 0:
-      if Debug: print(f'APM for {disk[1]} set to: {APM}')  
+    Done, Err = AtaRun(disk.Node, AtaSetAPM, APM)
+    if Err != None: return Err
+    if Done == None:
+      result = subprocess.run(['/usr/sbin/smartctl', '--set=apm,'+str(APM), disk.Node], capture_output=True, text=True)
+    if (Done != None) or (result.returncode == 0):
+      if Debug: print(f'APM for {disk.Node} set to: {APM}')
       return None
     Lines = result.stdout.splitlines()
     Lines = [line for line in Lines if line.strip()]
@@ -2615,19 +4427,21 @@ def SetTargetAPM(disk):  # call it under devLock
   except Exception as E:
     return f'Error at SetTargetAPM: {E}'
 
-def ApmAvailable(serial, check=True):
+def ApmAvailable(serial, check=True, dev_node=None):
   try:
     with cfgLock:
       ApmAvail = Config['ApmAvail']
       if serial in ApmAvail:
         return 2 if ApmAvail.getboolean(serial) else 1
-      if not check: return 0
-      APM = GetAPM(DevNode(serial))[0]
-      if APM == None: return False
-      HasAPM = APM != 0x200
+    if not check: return 0
+    if dev_node == None: dev_node = DevNode(serial)
+    APM = GetAPM(dev_node)[0]                # query outside the lock, disks can be probed in parallel
+    if APM == None: return False
+    HasAPM = APM != 0x200
+    with cfgLock:
       ApmAvail[serial] = 'yes' if HasAPM else 'no'
       SaveConfig()
-      return 2 if HasAPM else 1      
+    return 2 if HasAPM else 1
   except Exception as E:
     if Debug: print(RED+f' ApmAvailable error: {E}'+RESET)
     return 0
@@ -2655,13 +4469,15 @@ def SDRequest(event):
 
 # [THREAD]: BlockDev Monitor callback
 
-def OnDevUpdate():
+def OnDevUpdate(Events, MountsChanged=False):
   try:
+    Changed = ApplyDevEvents(Events)
+    if MountsChanged:
+      with devLock: Changed = UpdatePartMounts() or Changed
+    if not Changed: return
     with devLock:
-      UpdateBlockDevices()
-      buff = PackBlockDevices()
       if Debug: ShowStatInfo()
-    SendBuff(CMD_DEVICES, buff)
+    PushDevices()
     RemoveUnmounted()
   except: pass
 
@@ -2689,9 +4505,10 @@ def ServerThread(EndFlag): #----------------------------------------------------
 
   def UnmountPart(mpoint):
     warn = ''
-    result = subprocess.run(['umount', '-v', mpoint], capture_output=True, text=True)
-    if result.returncode != 0:
-      return 3, f'Unmount error {result.returncode} > {result.stderr.strip()}'
+    if Mounts.Mounted(mpoint):
+      result = subprocess.run(['umount', '-v', mpoint], capture_output=True, text=True)
+      if result.returncode != 0:
+        return 3, f'Unmount error {result.returncode} > {result.stderr.strip()}'
     err = ChangeFileLines('/etc/fstab', [], [mpoint])
     if err != '': return 2, 'Warning (failed to update /etc/fstab): '+err
     err = CheckMount(mpoint)
@@ -2714,73 +4531,25 @@ def ServerThread(EndFlag): #----------------------------------------------------
     mnt_line = f'UUID={uuid} {mpoint} {fstype} defaults,noatime,nodiratime,nofail,async 0 0'
     err = ChangeFileLines('/etc/fstab', [mnt_line], [mpoint])
     if err != '': return 3, 'Error (failed to update /etc/fstab): '+err
-    result = subprocess.run(['mount', '-v', mpoint], capture_output=True, text=True)
-    if result.returncode != 0:
-      return 3, f'Mount error {result.returncode} > {result.stderr.strip()}'
+    if not Mounts.Mounted(mpoint):
+      result = subprocess.run(['mount', '-v', mpoint], capture_output=True, text=True)
+      if result.returncode != 0:
+        return 3, f'Mount error {result.returncode} > {result.stderr.strip()}'
     result = subprocess.run(['systemctl', 'daemon-reload'], capture_output=True, text=True)
     if result.returncode != 0:
       return 3, f'Systemd reload error {result.returncode} > {result.stderr.strip()}'
     return 1, f'The partition was successfully mounted: {mpoint}'
 
-  def GetDevInfo(dev_node):
-    RData = ''
-    cmd = ['/usr/sbin/smartctl', '-i', '--get=all', dev_node]
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    lines = result.stdout.splitlines()
-    if result.returncode == 0:
-      valid = True
-      for i in range(len(lines) - 1, -1, -1):
-        if valid:
-          if lines[i].startswith('Device is') or lines[i].startswith('Local Time') or (len(lines[i]) == 0):
-            del lines[i]
-          elif lines[i].startswith('==='):
-            valid = False
-            del lines[i]
-          else: lines[i] = re.sub(r'\s+', ' ', lines[i])
-        else: del lines[i]
-      RData = '\n'.join(lines)
-    else:
-      lines = [line for line in lines if line.strip()]
-      sctl_err = '\n'.join(lines[2:])
-      RData = '\n---SmartCtl Error:\n'+sctl_err
-    if len(RData) > 0: RData = RData + '\n'
-
-    cmd = ['/usr/sbin/hdparm', '-I', dev_node]
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if result.returncode == 0:
-      lines = result.stdout.splitlines()
-      i1 = None; i2 = None
-      for i in range(len(lines)):
-        if i1 == None:
-          if 'Commands/features' in lines[i]: i1 = i + 2
-        else:
-          if (len(lines[i]) < 1) or ((i >= i1) and (lines[i][0] != chr(9)) and (lines[i][0] != ' ')):
-            i2 = i - 1; break
-      else: i2 = i
-      if (i1 == None) or (i2 == None): return True, ''
-      tmp_line = lines[i1].lstrip('\t *')
-      start = len(lines[i1]) - len(tmp_line)
-      for i in range(len(lines)-1, -1, -1):
-        if (i > i2) or (i < i1) or (lines[i].find('unknown') == start): del lines[i]
-        else:
-          if '*' in lines[i][:start-1]: lines[i] = '   [X]  '+lines[i][start:]
-          else: lines[i] = '   [  ]  '+lines[i][start:]
-      lines.insert(0, 'Features (enabled/suported):')
-      if len(RData) > 0: RData = RData + '\n'
-      RData = RData + '\n'.join(lines)
-    else:
-      lines = result.stderr.splitlines()
-      lines = [line for line in lines if line.strip()]
-      hdparm_err = '\n'.join(lines)
-      if len(RData) > 0: RData = RData + '\n'
-      RData = RData + '---Hdparm:\n'+hdparm_err
-    if len(RData) > 0: RData = RData + '\n'
-    return RData
+  def GetDevInfo(dev_node):  # one smartctl --json run, it refreshes the SMART cache too
+    probe = ProbeSMART(dev_node)
+    if probe.Error != None: return '\n---SmartCtl Error:\n' + probe.Error + '\n'
+    serial = DevSerial(dev_node)
+    if serial != '': Smart.Store(serial, probe)
+    return SmartInfoText(probe)
 
   def SendDevices():
-    with devLock:
-      UpdateBlockDevices()
-      SendBuff(CMD_DEVICES, PackBlockDevices())
+    UpdateBlockDevices()
+    PushDevices(True)
 
   def SendSysLog():
     try:
@@ -2801,9 +4570,9 @@ def ServerThread(EndFlag): #----------------------------------------------------
   # --- RealTime Info Thread -------------------
 
   def RTInfoThread(SelfObj, EndFlag, Access):
-    Terminated = False; failures = 0
+    Terminated = False; failures = 0; Rates = DiskRates()
     while not Terminated:
-      if SendBuff(CMD_RTINFO, PackRealTimeInfo()):
+      if SendBuff(CMD_RTINFO, PackRealTimeInfo(Rates)):
         failures = 0
         if Debug: print('RTI Send: success')
       else:
@@ -2816,7 +4585,7 @@ def ServerThread(EndFlag): #----------------------------------------------------
       SelfObj[0] = None
       Access.release()
 
-  def PackRealTimeInfo():
+  def PackRealTimeInfo(Rates):  # the disk load block is appended after the UPS registers
     CpuLoad = psutil.cpu_percent(interval=0.4)
     MemUsed = psutil.virtual_memory().percent
     UpTime = round(time.time() - BootTime)
@@ -2832,12 +4601,12 @@ def ServerThread(EndFlag): #----------------------------------------------------
       REG_IntTmp = 0
       REG_HddTmp = 0
       REG_ExtTmp = 0
-    return struct.pack('<ddQHHHHHB', CpuLoad, MemUsed, UpTime, CoreTemp, REG_IntTmp, REG_HddTmp, REG_ExtTmp, FanRpm, FanDuty) + bytes(UPS)
+    return struct.pack('<ddQHHHHHB', CpuLoad, MemUsed, UpTime, CoreTemp, REG_IntTmp, REG_HddTmp, REG_ExtTmp, FanRpm, FanDuty) + bytes(UPS) + \
+           Rates.Pack(list(DevReg.Snap.Serials))
 
   def StartRTI():
     global AppOpened
-    with devLock:
-      SendBuff(CMD_DEVICES, PackBlockDevices())
+    PushDevices(True)
     with rtiLock:
       AppOpened = True
       if RTIThread[0] == None:
@@ -2846,9 +4615,9 @@ def ServerThread(EndFlag): #----------------------------------------------------
         RTIThread[0].start()
 
   def StopRTI():
-    global AppOpened
+    global AppOpened, DevDeltaEn
     with rtiLock:
-      AppOpened = False
+      AppOpened = False; DevDeltaEn = False
       if RTIThread[0] != None:
         RTIEnd.set()
         RTIThread[0].join()
@@ -2982,7 +4751,7 @@ def ServerThread(EndFlag): #----------------------------------------------------
   # --- Client Handler -------------------------------
 
   def HandleClient(Conn):
-    global AndroMsgPool, AMPModified
+    global AndroMsgPool, AMPModified, DevDeltaEn
     nonlocal TCPRestart, LastCMD, Terminal
 
     def ReadSmallStr(raw=False):
@@ -3079,22 +4848,38 @@ def ServerThread(EndFlag): #----------------------------------------------------
 
         elif CMD == CMD_DEVICES: SendDevices()
 
+        elif CMD == CMD_DEVSTAT:
+          with rtiLock: DevDeltaEn = AppOpened
+          SendResult(DevDeltaEn)
+
+        elif CMD == CMD_STBLEARN:
+          SendBuff(CMD_STBLEARN, PackStandbyCfg(True))
+
+        elif CMD == CMD_PREDSTAT:
+          SendBuff(CMD_PREDSTAT, Predict.Pack())
+
+        elif CMD == CMD_WEARSTAT:
+          with cfgLock: Buff = Wear.Pack(Config['StandbyAdaptive'])
+          SendBuff(CMD_WEARSTAT, Buff)
+
+        elif CMD == CMD_WAKERS:
+          SendBuff(CMD_WAKERS, Wakers.Pack())
+
+        elif CMD == CMD_LOCKSTAT:
+          SendBuff(CMD_LOCKSTAT, struct.pack('<B', 2) + devLock.Pack() + cfgLock.Pack())
+
         elif CMD == CMD_DINFO:
           dev_node = ReadSmallStr()
           SendBuff(CMD_DINFO, PackSStr(DevSerial(dev_node)) + PackStr(GetDevInfo(dev_node)), False)
           UpdatePowerStatus(dev_node)
 
-        elif CMD == CMD_SMART:
+        elif CMD == CMD_SMART: RequestSMART(ReadSmallStr())
+
+        elif CMD == CMD_SMARTHIST:
           dev_node = ReadSmallStr()
-          Attrs, Err = GetSMART(dev_node)
-          if Attrs != None:
-            SPack, Err = PackSMART(Attrs)
-            if SPack != None:
-              SPack = struct.pack('<I', len(SPack)) + SPack
-              Health, Err = GetHealth(dev_node)
-          if Err != None: SendMessageToComp(CMD_MESSAGE, Err, 3)
-          else: SendBuff(CMD_SMART, PackSStr(DevSerial(dev_node)) + PackSStr(Health) + SPack, False)
-          UpdatePowerStatus(dev_node)
+          Span, Points = struct.unpack('<IH', Conn.recv(6))
+          serial = DevSerial(dev_node)
+          SendBuff(CMD_SMARTHIST, PackSStr(serial) + SmartHist.Trend(serial, Span, Points))
 
         elif CMD == CMD_GETAPM:
           dev_node = ReadSmallStr()
@@ -3104,30 +4889,31 @@ def ServerThread(EndFlag): #----------------------------------------------------
             SendMessageToComp(CMD_MESSAGE, Err, 3)
           else:
             with devLock:
-              I = GetDiskIndex(dev_node)
-              if (I != None) and (DevList[I][7] == 0):
-                DevList[I][7] = int(APM != 0x200) + 1
+              disk = DevReg.Disk(dev_node)
+              if (disk != None) and (disk.ApmAvail == 0):
+                disk.ApmAvail = int(APM != 0x200) + 1
                 send = True
                 with cfgLock:
-                  Config['ApmAvail'][DevList[I][2]] = 'no' if APM == 0x200 else 'yes'
+                  Config['ApmAvail'][disk.Serial] = 'no' if APM == 0x200 else 'yes'
                   SaveConfig()
             SendBuff(CMD_GETAPM, PackSStr(DevSerial(dev_node)) + struct.pack('<H', APM), False)
           if UpdatePowerStatus(dev_node, False) or send:
-            with devLock: SendBuff(CMD_DEVICES, PackBlockDevices())
+            PushDevices()
 
         elif CMD == CMD_SETLABEL:
           part_node = ReadSmallStr()
           label = ReadSmallStr()
           with devLock:
             uuid, fstype, mpoint = PartMountInfo(part_node)
-            if (uuid != None) and (len(uuid) > 0):
-              if ('ext' in fstype) and (len(mpoint) == 0):
-                Level, ResMsg = SetLabel(part_node, label)
-                D, P = GetPartIndex(part_node)
-                UpdatePowerStatus(DevList[D][1], False)
-                UpdateBlockDevices()
-                SendBuff(CMD_DEVICES, PackBlockDevices())
-                SendMessageToComp(CMD_MESSAGE, ResMsg, Level)
+            disk, part = DevReg.Part(part_node)
+          if (uuid != None) and (len(uuid) > 0):
+            if ('ext' in fstype) and (len(mpoint) == 0):
+              Level, ResMsg = SetLabel(part_node, label)
+              Props.Invalidate(part.Name)
+              UpdatePowerStatus(disk.Node, False)
+              UpdateBlockDevices()
+              PushDevices()
+              SendMessageToComp(CMD_MESSAGE, ResMsg, Level)
 
         elif CMD == CMD_MOUNT:
           dev_node = ReadSmallStr()
@@ -3231,12 +5017,12 @@ def ServerThread(EndFlag): #----------------------------------------------------
         elif CMD == CMD_SETSTBCFG:
           StbBuff = ReadCmdBuff()
           SendResult(SetStbConfig(StbBuff));
-          with devLock: SendBuff(CMD_DEVICES, PackBlockDevices())
+          PushDevices()
 
         elif CMD == CMD_SETAPMCFG:
           ApmBuff = ReadCmdBuff()
           SendResult(SetApmConfig(ApmBuff));
-          with devLock: SendBuff(CMD_DEVICES, PackBlockDevices())
+          PushDevices()
 
         elif CMD == CMD_SETNOTCFG:
           NotifBuff = ReadCmdBuff()
@@ -3429,9 +5215,9 @@ async def StartInitTask():
       await asyncio.sleep(2)
       if AsyncTerminated: return
 
+    if Debug and not StartInStandby: print('Waking up all disks...')
+    UpdateBlockDevices()
     with devLock:
-      if Debug and not StartInStandby: print('Waking up all disks...')
-      UpdateBlockDevices()
       if Debug:
         print('')
         ShowDiskInfo()
@@ -3524,6 +5310,7 @@ async def TimerTask():
       if SEcounter >= 60:
         SoundEn = GetSoundEn()
         SEcounter = 0
+        if Debug: ShowLockStats()
         SendDebug1(False)  # Debug!
       await asyncio.sleep(2)
       if SDcounter > 0:
@@ -3584,6 +5371,7 @@ async def UPSEventsTask():
 
       if NewRegPwr != REG_Power:
         REG_Power = NewRegPwr
+        SpinUp.SetPower(REG_Power == stPowerOFF)
         if REG_Power == stPowerON:
           if Debug: print('Power Supply: ON')
           if EventsEnabled: BroadcastMsg(MainAvailMsg, 1)
@@ -3611,47 +5399,97 @@ async def UPSEventsTask():
   finally: TaskExit('UPS Events')
 
 
+def EvalDisk(disk, now, busy, Actions):  # call it under devLock, Actions are run by RunDiskActions / return: True if the disk state was changed
+  DStat = disk.Stat; Changed = False
+  if busy:                                                             # we have activity
+    if disk.Managed():
+      StbLearn.Record(disk.Serial, now - DStat.IdleStamp)             #  the idle gap it just ended
+      Predict.Touch(disk.Serial, DStat.State == 2, now)                #  pre-spin hit or stall
+    DStat.Touch(now)                                                   # reset KA and Idle periods
+    if disk.Managed() and (DStat.State == 2):                          # we have a HDD in standby
+      DStat.State = 1; DStat.StateName = 'active'                      #  mark it as active
+      Actions.append((disk, 'apm'))                                    #  update APM
+      Changed = True                                                   #  mark for status update
+  elif disk.Managed() and (DStat.State == 1):                          # an active HDD reached its deadline
+    Unit = max(CheckPeriod, 1)
+    if (DStat.SBT > 0) and (now >= DStat.IdleStamp + DStat.SBT * Unit):  # SB period is over
+      Actions.append((disk, 'standby'))                                #  put the drive in standby
+      DStat.KAStamp = now                                              #  reset KA
+      DStat.State = 2; DStat.StateName = 'standby'                     #  mark inactive
+      Changed = True                                                   #  mark for status update
+    elif (DStat.KAS > 0) and (now >= DStat.KAStamp + DStat.KAS * Unit):  # KA period is over
+      Actions.append((disk, 'ka'))                                     #  send KeepAlive
+      DStat.KAStamp = now                                              #  reset KA
+  DiskSched.Schedule(disk)
+  return Changed
+
+def RunDiskActions(Actions):  # the commands decided by EvalDisk, sent after devLock was released
+  Sleep = [disk for disk, act in Actions if act == 'standby']
+  Alive = [disk for disk, act in Actions if act == 'ka']
+  if Sleep: AtaForAll([disk.Node for disk in Sleep], PutInStandby)
+  if Alive: KASrv.KeepAlive([disk.Node for disk in Alive], Awake=True)
+  for disk, act in Actions:
+    if act != 'apm': continue
+    if disk.ApmAvail == 0: disk.ApmAvail = ApmAvailable(disk.Serial)
+    SetTargetAPM(disk)
+  with devLock:
+    for disk in Sleep + Alive:                                         # exclude our own commands from the IO count
+      if DevReg.Disk(disk.Node) is disk: SyncCounters(disk)
+
 async def DevicesTask():
   TaskEnter('Devices')
   try:
+    LastTick = time.monotonic()
     while not AsyncTerminated:
-      with clkLock: count = CheckPeriod // 2
-      while not AsyncTerminated and (count > 0):
-        await asyncio.sleep(2)
-        count -= 1
+      with devLock: Next = DiskSched.Next()
+      Delay = DiskPollPeriod
+      if Next != None: Delay = min(Delay, max(Next - time.monotonic(), 0))
+      await asyncio.sleep(Delay)
       if not AsyncTerminated:
 
         with devLock:
-          SendDevUpdate = False
+          SendDevUpdate = False; now = time.monotonic(); Alerts = []; Busy = set(); Actions = []
+          Before = {disk.Node: disk.Stat.State for disk in DevReg}
           UpdateCounters()
-          for disk in DevList:
-            new_count = GetDiskCount(disk[0])
-            delta = new_count - disk[5][0]; disk[5][0] = new_count
-            if (disk[4] == 2) and (disk[5][5] > 0) and (disk[5][3] == 1):  # we have a HDD with enabled KA in active state
-              if delta == 0: disk[5][1] += 1                               #  is Idle ? Inc(KA)
-              if disk[5][1] >= disk[5][5]:                                 #  KA period over ?
-                IOs = KeepAlive(disk[1])                                   #   send KeepAlive
-                disk[5][1] = 0; disk[5][0] += IOs                          #   reset KA and adjust IO count
-            if delta > 0:      # we have activity
-              disk[5][1] = 0; disk[5][2] = 0                               # Reset KA and Idle counters
-              if (disk[4] == 2) and (disk[5][3] == 2):                     # we have a HDD in standby
-                disk[5][3] = 1; disk[5][4] = 'active'                      #  mark it as active
-                if disk[7] == 0: disk[7] = ApmAvailable(disk[2])           #  update APM Avail
-                SetTargetAPM(disk)                                         #  update APM
-                SendDevUpdate = True                                       #  mark for status update
-            else:              # no disk activity
-              disk[5][2] += 1                                              # Inc(Idle)
-              if (disk[4] == 2) and (disk[5][6] > 0):                      # we have a HDD with enabled SB
-                if (disk[5][3] == 1) and (disk[5][2] >= disk[5][6]):       #  if it is active and SB period is over
-                  PutInStandby(disk[1])                                    #    put the drive in standby
-                  disk[5][1] = 0                                           #    reset KA
-                  disk[5][3] = 2; disk[5][4] = 'standby'                   #    mark inactive
-                  UpdateCounters(); disk[5][0] = GetDiskCount(disk[0])     #    reset IO count
-                  SendDevUpdate = True                                     #    mark for status update
-          if Debug: ShowStatInfo()
-          with rtiLock:
-            if AppOpened or SendDevUpdate:
-              SendBuff(CMD_DEVICES, PackBlockDevices())
+          for disk in DevReg:                                  # disks with IO changes are evaluated now
+            Alert = Latency.Update(disk, now)                  #  latency from the same diskstats sample
+            if Alert != None: Alerts.append(Alert)
+            delta, busy = DiskActivity(disk)
+            if disk.Stat.Waking: continue                      #  our own wake read, SwitchToActive settles it
+            if busy: Busy.add(disk.Node)
+            if busy and EvalDisk(disk, now, True, Actions): SendDevUpdate = True
+          for disk in DiskSched.Due(now):                      # the others only when their deadline fires
+            if EvalDisk(disk, now, False, Actions): SendDevUpdate = True
+          Wake, Changed = SyncGroups(Before, Busy, now, Actions)  # volume group members follow each other
+          if Changed: SendDevUpdate = True
+          for disk in DevReg:                                  # spin cycles and state time, whoever changed the state
+            if disk.Managed() and (disk.Serial != ''): Wear.Observe(disk.Serial, disk.Stat.State, now)
+          Woken = [node for node in Busy if Before.get(node) == 2]
+          Asleep = any(disk.Managed() and (disk.Stat.State == 2) for disk in DevReg)
+          Tick = now - LastTick >= CheckPeriod
+          if Tick:
+            LastTick = now; TTL = SmartTTL()
+            RefreshGroups()                                    # arrays assembled after the disks were probed
+            for disk in DevReg:                                # SMART samples only from awake disks
+              if (disk.Serial != '') and (disk.Stat.State != 2) and Smart.Due(disk.Serial, TTL):
+                Smart.Refresh(disk.Node, disk.Serial)
+              if disk.Managed():                               # learned standby timeouts follow the new gaps
+                KAS, SBT = GetDevStandbyParams(disk.Serial)
+                if (KAS == disk.Stat.KAS) and (SBT != disk.Stat.SBT) and (SBT > 0):
+                  disk.Stat.SBT = SBT; DiskSched.Schedule(disk)
+            with cfgLock:
+              Wake += Predict.Tick([(disk.Serial, disk.Node, disk.Stat.State == 2) for disk in DevReg
+                                    if disk.Managed() and (disk.Serial != '')], now, Config['Prespin'])
+          Wake = [node for node in set(Wake) if ClaimWake(node)]  # marked before the lock is released, the learners skip the wake
+          if Debug and (Tick or SendDevUpdate): ShowStatInfo()
+        RunDiskActions(Actions)                                # disk commands never hold devLock
+        with rtiLock: Push = (AppOpened and Tick) or SendDevUpdate
+        if Push: PushDevices()
+        for MsgCode, LID, Params in Alerts: BroadcastMsg(MsgCode, LID, Params)
+        Wakers.Round(Woken, Asleep)
+        for dev_node in Wake:                                  # the normal wake path, without queue messages
+          threading.Thread(target=SwitchToActive, args=(dev_node, None, True), name='Group Wake', daemon=True).start()
+        if Tick: StbLearn.Save(); Predict.Save(); Wear.Save()
 
   except asyncio.CancelledError: pass
   finally: TaskExit('Devices')
@@ -3709,6 +5547,7 @@ LogExceptFile = RunPath+'/nas_except.log'
 TermFile = RunPath+'/term.bin'
 AMPFile  = RunPath+'/pool_andro.bin'
 SafeShdFile = '/var/safe_shd'  # a flag file to detect power failures
+TracePidFile = RunPath+'/trace.pid'  # the daemon that owns the tracefs instance
 
 RebootCfg  = [RebootCfg[0].replace('%RunPath%', RunPath)]
 PwrOffCfg  = [PwrOffCfg[0].replace('%RunPath%', RunPath)]
@@ -3733,9 +5572,11 @@ LogD(6, 'Settings loaded')
 AsyncTerminated = False
 EventsEnabled   = False
 AppOpened       = False
+DevDeltaEn      = False                      # the app accepts CMD_DEVSTAT delta updates
 PiSynced        = False
 GraphsHandled   = False
-BootTime        = psutil.boot_time()
+BootTime        = None if HookMode else psutil.boot_time()
+PushTimeout     = 10                         # push notification request timeout (seconds)
 
 ICount          = 0
 RPM_StartTime   = 0
@@ -3783,11 +5624,10 @@ GpioMon      = None
 I2CBus       = None
 FanPWM       = None
 SaveCfgTimer = None
-UPSEvent     = asyncio.Event()
+UPSEvent     = None if HookMode else asyncio.Event()
 TCPSrvEnd    = threading.Event()
-devLock      = threading.RLock()
-cfgLock      = threading.RLock()
-clkLock      = threading.RLock()
+devLock      = InstrumentedLock('devLock')
+cfgLock      = InstrumentedLock('cfgLock')
 rtiLock      = threading.RLock()
 i2cLock      = threading.RLock()
 upsLock      = threading.RLock()
@@ -3795,9 +5635,24 @@ pflLock      = threading.RLock()
 logLock      = threading.RLock()
 tmbLock      = threading.RLock()  # TermBuff
 ampLock      = threading.RLock()  # AndroMsgPool
-UDEV         = pyudev.Context()
-Counters     = ()
-MountPoints  = ()
+UDEV         = None if HookMode else pyudev.Context()
+RootDisk     = FindRootDisk()
+DevReg       = DeviceRegistry()
+Props        = PropsCache()
+DStats       = DiskStats()
+Mounts       = MountTable()
+DiskSched    = DiskScheduler()
+Latency      = LatencyMonitor()
+StbLearn     = StandbyLearner(RunPath+'/stb_learned.json')
+Predict      = AccessPredictor(RunPath+'/prespin.json')
+Wear         = WearLedger(RunPath+'/wear.json')
+Wakers       = WakeTracer()
+SpinUp       = SpinUpScheduler()
+KASrv        = KAService()
+AtaIO        = FakeAtaTransport() if FakeAta else SgTransport()
+SmartHist    = SmartHistory(RunPath+'/smart')
+Smart        = SmartCache()
+AtaFallback  = set()                          # nodes behind bridges without ATA pass-through
 
 LogD(7, 'Global variables inited')
 
@@ -3815,19 +5670,10 @@ LogD(8, 'Message pools loaded')
 
 for param in ParamList:
   if param == '-shutdown':
-    PowerOffHDDs()
-    BroadcastMsg(ShutdownMsg, 3)
-    SaveAndroMsgPool()
-    SendBuff(CMD_THEEND, b'', False, False)
-    time.sleep(0.5)
-    SignalToCutThePower()
+    RunShutdownHook(ShutdownMsg, 3, True)
     sys.exit(0)
   elif param == '-reboot':
-    PowerOffHDDs()
-    BroadcastMsg(RebootMsg, 2)
-    SaveAndroMsgPool()
-    SendBuff(CMD_THEEND, b'', False, False)
-    time.sleep(0.5)
+    RunShutdownHook(RebootMsg, 2, False)
     sys.exit(0)
   elif param == '-srvaddr':
     print(GetServerAddr())
@@ -3887,6 +5733,7 @@ for param in ParamList:
   elif param == '-disk:off':
     StartInStandby = True
 LogD(10, 'Standby flag handled')
+Wakers.Start()
 
 # Check if the script is installed...
 
@@ -3974,6 +5821,7 @@ try:
     REG_Battery = bytes(SBuff[8:12])
     REG_BatOver = bytes(SBuff[12:])
   except: pass
+  SpinUp.SetPower(REG_Power == stPowerOFF)   # the startup probes already follow the battery limit
   LogD(20, 'UPS regs inited')
 
   # Setting up GPIO ports and starting GPIO Monitor thread...
@@ -4026,6 +5874,11 @@ if ExitCmd >= exShutdownNAS:
 
 if TCPSrv  != None: StopTCPServer()
 if DevMon  != None: DevMon.Terminate()
+KASrv.Terminate()
+Wakers.Terminate()
+StbLearn.Save(True)
+Predict.Save(True)
+Wear.Save(True)
 if NAlert  != None: NAlert.release()
 if GpioMon != None: GpioMon.Terminate()
 if I2CBus  != None: I2CBus.close()